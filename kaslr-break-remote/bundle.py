@@ -0,0 +1,184 @@
+import os
+import mmap
+import struct
+import hashlib
+import click
+from addict import Dict
+from lazyimport import lazy_import
+
+from pagestore import store, page_hash
+from relocation import relocation_table
+
+# Loaded when a profile is read or page variants are built
+yaml = lazy_import('yaml')
+np = lazy_import('numpy')
+
+
+PAGE_SIZE = 4096
+
+# Bundle layout:
+#   header (padded to one page)
+#   pages: npages * 4096 bytes, in profile order (binary_pages, then pages)
+#   index: nrelocs * (uint32 page, uint32 byte offset) of all pointer slots
+#   hashes: npages * SHA-256 of the page content, the page store keys
+#   flags: npages * uint8, AUTO_OFFSETS for pages with `offsets: -1` whose
+#          kernel pointers are detected at load time (no index entries)
+MAGIC = b'KASLRPB\x00'
+VERSION = 4
+AUTO_OFFSETS = 1
+HEADER = struct.Struct('<8sIII32s')
+# Fields of the index entries, a NumPy dtype spec
+INDEX_FIELDS = [('page', '<u4'), ('offset', '<u4')]
+
+
+def bundle_path(config_file):
+    return os.path.splitext(config_file)[0] + '.bundle'
+
+
+def profile_sources(config, config_file):
+    """Returns the page files of a profile as (path, offsets) in load order.
+    Offsets are None for YAML pages, which carry their own."""
+    config_dir = os.path.dirname(config_file)
+    sources = []
+
+    for config_page in config.binary_pages or []:
+        sources.append((os.path.join(config_dir, config_page.file), config_page.offsets))
+
+    for config_page in config.pages or []:
+        sources.append((os.path.join(config_dir, config_page.file), None))
+
+    return sources
+
+
+def is_stale(config, config_file, path):
+    if not os.path.exists(path):
+        return True
+
+    # Bundles of an older format are rebuilt as well
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size or HEADER.unpack(header)[0:2] != (MAGIC, VERSION):
+        return True
+
+    bundle_mtime = os.path.getmtime(path)
+    files = [config_file] + [x for x, _ in profile_sources(config, config_file)]
+
+    return any(os.path.getmtime(x) > bundle_mtime for x in files)
+
+
+def read_page_source(page_file, page_offsets):
+    if page_offsets is None:
+        with open(page_file, 'r') as f:
+            page_meta = yaml.safe_load(f)
+            page_content = page_meta['data']
+            page_offsets = page_meta['offsets']
+    else:
+        with open(page_file, 'rb') as f:
+            page_content = f.read()
+
+    return page_content[0:PAGE_SIZE], page_offsets
+
+
+def compile_profile(config, config_file, path=None):
+    path = path or bundle_path(config_file)
+    click.echo(f'Compiling profile {config_file} to {path}')
+
+    sources = profile_sources(config, config_file)
+    pages = np.zeros((len(sources), PAGE_SIZE), dtype=np.uint8)
+    flags = np.zeros(len(sources), dtype=np.uint8)
+    index = []
+
+    for page_idx, (page_file, page_offsets) in enumerate(sources):
+        page_content, page_offsets = read_page_source(page_file, page_offsets)
+        pages[page_idx, 0:len(page_content)] = np.frombuffer(page_content, dtype=np.uint8)
+        if page_offsets == -1:
+            flags[page_idx] = AUTO_OFFSETS
+        else:
+            index.extend((page_idx, offset) for offset in page_offsets)
+
+    index = np.array(index, dtype=INDEX_FIELDS)
+    hashes = b''.join(bytes.fromhex(page_hash(page)) for page in pages)
+
+    content_hash = hashlib.sha256()
+    content_hash.update(pages.tobytes())
+    content_hash.update(index.tobytes())
+    content_hash.update(flags.tobytes())
+
+    header = HEADER.pack(MAGIC, VERSION, len(sources), len(index), content_hash.digest())
+
+    # Write atomically, attackers may start concurrently
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(PAGE_SIZE, b'\x00'))
+        f.write(pages.tobytes())
+        f.write(index.tobytes())
+        f.write(hashes)
+        f.write(flags.tobytes())
+    os.replace(tmp_path, path)
+
+    return path
+
+
+class ProfileBundle:
+    """Compiled profile mapped into memory.
+
+    The file is mapped copy-on-write, so pages can be patched in place
+    without touching the bundle on disk.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic, version, npages, nrelocs, content_hash = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Invalid profile bundle {path}')
+
+        self.path = path
+        self.npages = npages
+        self.content_hash = content_hash.hex()
+        self.pages = np.frombuffer(self._mmap, dtype=np.uint8, count=npages * PAGE_SIZE, offset=PAGE_SIZE).reshape(npages, PAGE_SIZE)
+        self.index = np.frombuffer(self._mmap, dtype=INDEX_FIELDS, count=nrelocs, offset=PAGE_SIZE + npages * PAGE_SIZE)
+
+        hashes_start = PAGE_SIZE + npages * PAGE_SIZE + nrelocs * np.dtype(INDEX_FIELDS).itemsize
+        self.hashes = [self._mmap[x:x + 32].hex() for x in range(hashes_start, hashes_start + npages * 32, 32)]
+        self.flags = np.frombuffer(self._mmap, dtype=np.uint8, count=npages, offset=hashes_start + npages * 32)
+
+    def page(self, page_idx):
+        start = PAGE_SIZE + page_idx * PAGE_SIZE
+        return memoryview(self._mmap)[start:start + PAGE_SIZE]
+
+
+def load_profile_bundle(config, config_file, kernel_text_mapping):
+    """Loads the pages of a profile from its bundle, recompiling it first if
+    it is missing or older than any of its source files."""
+    path = bundle_path(config_file)
+    if is_stale(config, config_file, path):
+        compile_profile(config, config_file, path)
+
+    click.echo(f'Loading profile bundle {path}')
+    bundle = ProfileBundle(path)
+
+    bounds = np.searchsorted(bundle.index['page'], np.arange(bundle.npages + 1)).tolist()
+
+    pages = []
+    for page_idx in range(bundle.npages):
+        begin, end = bounds[page_idx], bounds[page_idx + 1]
+
+        # Pages already known from another profile are shared
+        page_key = store.add(bundle.page(page_idx), bundle.hashes[page_idx])
+        page = store.get(page_key)
+
+        page_offsets = bundle.index['offset'][begin:end]
+        if bundle.flags[page_idx] & AUTO_OFFSETS:
+            page_offsets = -1
+        page_offsets, kernel_offsets = relocation_table(page, page_offsets, kernel_text_mapping)
+
+        pages.append(Dict({
+            'page': page,
+            'hash': page_key,
+            'offsets': page_offsets,
+            'kernel_offsets': kernel_offsets
+        }))
+
+    return bundle, pages
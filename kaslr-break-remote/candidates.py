@@ -0,0 +1,85 @@
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+
+# 512 slots of 2 MiB above the kernel text mapping, the KASLR layout of the
+# x86_64 kernel image
+CANDIDATE_BASE = 0xffffffff80000000
+CANDIDATE_ALIGNMENT = 2 * 1024 * 1024
+CANDIDATE_COUNT = 512
+
+# Candidates built per chunk when streaming variants
+CHUNK_SIZE = 256
+
+
+def parse_size(value):
+    """Accepts ints and strings like '0x200000' or '4096'."""
+    if isinstance(value, str):
+        return int(value, 0)
+    return value
+
+
+class CandidateSpace:
+    """Candidate addresses the pages are relocated to.
+
+    Candidate i is `base + i * step`. Every candidate has to be aligned to
+    alignment (CONFIG_PHYSICAL_ALIGN for the kernel image, the page size for
+    modules), step defaults to it. The default space is the one of the
+    kernel image; module regions or finer granularities are described by a
+    `candidates` entry in the profile, e.g.
+
+        candidates:
+          base: 0xffffffffc0000000
+          alignment: 0x1000
+          count: 65536
+
+    Candidates are only referred to by index, their variants are built in
+    chunks of chunk_size so memory stays bounded by the chunk, not by count.
+    """
+
+    def __init__(self, base=CANDIDATE_BASE, step=None, count=CANDIDATE_COUNT, alignment=CANDIDATE_ALIGNMENT, chunk_size=CHUNK_SIZE):
+        step = step or alignment
+
+        if alignment <= 0 or alignment & (alignment - 1) != 0:
+            raise ValueError(f'Candidate alignment {alignment:#x} is not a power of two')
+        if base % alignment != 0 or step % alignment != 0:
+            raise ValueError(f'Candidate base {base:#x} and step {step:#x} must be aligned to {alignment:#x}')
+        if count <= 0 or base + (count - 1) * step >= 1 << 64:
+            raise ValueError(f'Invalid candidate count {count}')
+
+        self.base = base
+        self.step = step
+        self.count = count
+        self.alignment = alignment
+        self.chunk_size = max(1, chunk_size)
+
+    @classmethod
+    def from_config(cls, config, base=CANDIDATE_BASE):
+        candidates = config.candidates
+        return cls(
+            base=parse_size(candidates.base or base),
+            step=parse_size(candidates.step or None),
+            count=candidates.count or CANDIDATE_COUNT,
+            alignment=parse_size(candidates.alignment or CANDIDATE_ALIGNMENT)
+        )
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return f'CandidateSpace(base={self.base:#x}, step={self.step:#x}, count={self.count}, alignment={self.alignment:#x})'
+
+    def addresses(self, indices):
+        """Candidate addresses as uint64, wrapping like the pointers."""
+        indices = np.asarray(indices, dtype=np.uint64)
+        return np.uint64(self.base) + indices * np.uint64(self.step)
+
+    def address(self, index):
+        return self.base + index * self.step
+
+    def chunks(self, indices):
+        """Splits indices into arrays of at most chunk_size candidates."""
+        indices = np.asarray(indices, dtype=np.int64)
+        for i in range(0, len(indices), self.chunk_size):
+            yield indices[i:i + self.chunk_size]
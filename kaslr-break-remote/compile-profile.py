@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+import click
+
+from bundle import bundle_path, compile_profile, is_stale, ProfileBundle
+from config import load_config_file
+
+
+@click.command()
+@click.argument('config_files', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('-f', '--force', is_flag=True, default=False)
+def main(config_files, force):
+    """Compile profiles into memory-mappable page bundles"""
+    for config_file in config_files:
+        config = load_config_file(config_file)
+        path = bundle_path(config_file)
+
+        if force or is_stale(config, config_file, path):
+            compile_profile(config, config_file, path)
+        else:
+            click.echo(f'{path} is up to date')
+
+        bundle = ProfileBundle(path)
+        click.echo(f'{bundle.npages} pages, {len(bundle.index)} pointers, {bundle.content_hash}')
+
+
+if __name__ == "__main__":
+    main()
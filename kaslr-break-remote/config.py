@@ -1,6 +1,8 @@
-import yaml
 from voluptuous import Schema, Optional, Required, Any, Invalid
 from addict import Dict
+from lazyimport import lazy_import
+
+yaml = lazy_import('yaml')
 
 
 config_schema = Schema({
@@ -9,8 +11,15 @@ config_schema = Schema({
     Optional('device'): Any(str),
     Optional('monitor_traffic'): Any(bool),
     Optional('kernel_text_mapping'): Any(str),
-    Optional('backend'): Any('requests', 'aiohttp', 'httpx'),
+    Optional('backend'): Any('requests', 'aiohttp', 'httpx', 'h2time', 'pipeline'),
     Optional('http_version'): Any('http', 'http2'),
+    Optional('upload_format'): Any('hex', 'binary'),
+    Optional('candidates'): Schema({
+        Optional('base'): Any(int, str),
+        Optional('step'): Any(int, str),
+        Optional('count'): int,
+        Optional('alignment'): Any(int, str),
+    }),
     Optional('pages'): Any([Schema({
         Required('file'): Any(str),
     })]),
@@ -1,9 +1,17 @@
 import asyncio
+import functools
+from h2.config import H2Configuration
 from h2.connection import H2Connection
+from hpack import Encoder, NeverIndexedHeaderTuple
+from hpack.table import HeaderTable
 from hyperframe.frame import SettingsFrame
 from urllib.parse import urlparse, parse_qs
+import os
 import socket
-from h2.events import ResponseReceived, DataReceived
+import struct
+from h2.events import ResponseReceived, DataReceived, StreamEnded, StreamReset, WindowUpdated, RemoteSettingsChanged, SettingsAcknowledged, ConnectionTerminated, PingAckReceived
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque
 import ssl
 import time
 import string
@@ -11,6 +19,55 @@ import itertools
 import logging
 
 
+# Linux values, Python only exports them from 3.12 on
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@qq')
+
+# Names that have a static table index
+STATIC_HEADER_NAMES = frozenset(name for name, _ in HeaderTable.STATIC_TABLE)
+
+
+class CachingEncoder(Encoder):
+    """HPACK encoder that reuses the blocks of header lists which are all
+    never indexed and named in the static table (see
+    H2Request.get_request_headers). hpack prefers matches in the dynamic
+    table, so blocks are only stored while it is empty: they then refer to
+    the static table alone, which never changes, and stay valid on every
+    connection and in every state. Sending them costs a dictionary lookup.
+    """
+
+    def __init__(self, size=1024):
+        super().__init__()
+        self.size = size
+        self.hits = 0
+        self._blocks = {}
+
+    def encode(self, headers, huffman=True):
+        # h2 passes its normalized headers as a generator
+        headers = tuple(headers)
+        if self.header_table.resized or not all(isinstance(x, NeverIndexedHeaderTuple) and x[0] in STATIC_HEADER_NAMES for x in headers):
+            return super().encode(headers, huffman)
+
+        key = (headers, huffman)
+        block = self._blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            return block
+
+        block = super().encode(headers, huffman)
+        if len(self.header_table.dynamic_entries) == 0:
+            if len(self._blocks) >= self.size:
+                self._blocks.clear()
+            self._blocks[key] = block
+        return block
+
+
+def headers_length(headers):
+    """Length of the headers as text, an upper bound of their HPACK size."""
+    return sum(len(name) + len(value) + 3 for name, value in headers) - 1
+
+
 class H2Protocol(asyncio.Protocol):
     def __init__(self, settings: dict, loop: asyncio.AbstractEventLoop):
         super().__init__()
@@ -18,26 +75,44 @@ class H2Protocol(asyncio.Protocol):
         self.transport: asyncio.Transport = None
         self.peername = None
         self.socket = None
-        self.h2conn = H2Connection()
+        self.ssl_object = None
+        # Header lists come lower-cased and well-formed from H2Request, so h2
+        # does not need to normalize and validate them on every request
+        self.h2conn = H2Connection(config=H2Configuration(client_side=True, normalize_outbound_headers=False, validate_outbound_headers=False))
+        self.h2conn.encoder = CachingEncoder()
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.connection_open = False
 
         self._sent_streams = {}
+        self._sent_time = {}
         self._received_header = {}
+        self._received_data = {}
+        self._pending_data = {}
         self._settings = settings
         self._goaway_waiter = None
+        self._remote_settings = loop.create_future()
+        self._settings_acked = loop.create_future()
+        self._stream_closed = asyncio.Event()
+        self._pings = {}
+        self._arrival_time = None
+        self.flush_time = None
+        self.goaway = False
+        # Set by open_connection for https, gets the session ticket once it arrived
+        self.tls_target = None
 
     def connection_made(self, transport: asyncio.Transport) -> None:
         self.connection_open = True
         self.peername = transport.get_extra_info('peername')
         self.socket = transport.get_extra_info('socket')
-        ssl_socket = transport.get_extra_info('ssl_object')
+        self.ssl_object = transport.get_extra_info('ssl_object')
         negotiated_protocol = None
-        if ssl_socket is not None:
-            negotiated_protocol = ssl_socket.selected_alpn_protocol()
+        if self.ssl_object is not None:
+            negotiated_protocol = self.ssl_object.selected_alpn_protocol()
             if negotiated_protocol is None:
-                negotiated_protocol = ssl_socket.selected_npn_protocol()
+                negotiated_protocol = self.ssl_object.selected_npn_protocol()
+            if self.tls_target is not None:
+                self.tls_target.handshake(self.ssl_object, negotiated_protocol)
             if negotiated_protocol != "h2":
                 raise RuntimeError("The server does not support HTTP/2")
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -47,14 +122,49 @@ class H2Protocol(asyncio.Protocol):
         self.h2conn.initiate_connection()
         self.h2conn.update_settings(self._settings)
         self.write_all()
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
 
     def data_received(self, data: bytes) -> None:
+        self.data_received_at(data, None)
+
+    def data_received_at(self, data: bytes, arrival_time) -> None:
+        """data with the kernel receive time in ns (CLOCK_REALTIME like
+        time.time_ns()) of the segment that completed it, see
+        TimestampingTransport. Without it responses are stamped on parsing."""
+        self._arrival_time = arrival_time
+        if self.tls_target is not None and self.tls_target.remember(self.ssl_object):
+            self.tls_target = None
         events = self.h2conn.receive_data(data)
         for e in events:
             if isinstance(e, ResponseReceived):
                 self.receive_response(e.headers, e.stream_id)
             if isinstance(e, DataReceived):
+                self.h2conn.acknowledge_received_data(e.flow_controlled_length, e.stream_id)
                 self.receive_data(e.data, e.stream_id)
+            if isinstance(e, StreamEnded):
+                self.end_stream(e.stream_id)
+            if isinstance(e, StreamReset):
+                self._pending_data.pop(e.stream_id, None)
+                self.end_stream(e.stream_id, reset=True)
+            if isinstance(e, WindowUpdated):
+                for stream_id in list(self._pending_data):
+                    self.send_body(stream_id)
+            if isinstance(e, RemoteSettingsChanged) and not self._remote_settings.done():
+                self._remote_settings.set_result(None)
+            if isinstance(e, SettingsAcknowledged) and not self._settings_acked.done():
+                self._settings_acked.set_result(None)
+            if isinstance(e, PingAckReceived):
+                fut = self._pings.pop(e.ping_data, None)
+                if fut is not None and not fut.done():
+                    fut.set_result(None)
+            if isinstance(e, ConnectionTerminated):
+                # No new streams after GOAWAY, the pool replaces the connection
+                self.goaway = True
+
+        # Settings acks, window updates and flow-controlled bodies
+        data = self.h2conn.data_to_send()
+        if data:
+            self.transport.write(data)
 
     def write_all(self):
         data = self.h2conn.data_to_send()
@@ -64,6 +174,11 @@ class H2Protocol(asyncio.Protocol):
     def connection_lost(self, exc):
         self.connection_open = False
         self.remove_all_unacknowleged_streams()
+        for fut in [self._remote_settings, self._settings_acked, *self._pings.values()]:
+            if not fut.done():
+                fut.set_result(None)
+        self._pings.clear()
+        self._stream_closed.set()
         self.logger.info("Connection to %s closed" % self.peername[0])
         if self._goaway_waiter:
             self._goaway_waiter.set_result(None)
@@ -77,12 +192,129 @@ class H2Protocol(asyncio.Protocol):
         self._goaway_waiter = waiter
         await waiter
 
+    async def ready(self, timeout=5):
+        """Waits for the SETTINGS of the server and its ack of ours, stream
+        limits and windows are only known afterwards."""
+        await asyncio.wait_for(asyncio.shield(asyncio.gather(self._remote_settings, self._settings_acked)), timeout)
+        if not self.connection_open:
+            raise ConnectionError('Connection closed before the settings were exchanged')
+
+    @property
+    def usable(self):
+        """Open, settings exchanged, no GOAWAY and stream ids left."""
+        return (self.connection_open and not self.goaway and self._settings_acked.done()
+                and self.h2conn.highest_outbound_stream_id < 2**31 - 1024)
+
+    @property
+    def outstanding(self):
+        return sum(1 for x in self._sent_streams.values() if not x.done())
+
+    async def ping(self, timeout=1):
+        """True if the server answers a PING within timeout."""
+        if not self.usable:
+            return False
+
+        data = os.urandom(8)
+        fut = self.loop.create_future()
+        self._pings[data] = fut
+        self.h2conn.ping(data)
+        self.write_all()
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self._pings.pop(data, None)
+            return False
+        return self.usable
+
+    def response_futures(self, stream_ids):
+        return [self._sent_streams[x] for x in stream_ids if x in self._sent_streams]
+
+    def discard_streams(self, stream_ids):
+        """Drops the results of finished streams, so a reused connection
+        only tracks the streams of its current user."""
+        for stream_id in stream_ids:
+            self._sent_streams.pop(stream_id, None)
+            self._sent_time.pop(stream_id, None)
+
     def send_request(self, headers, end_stream=True):
         stream_id = self.h2conn.get_next_available_stream_id()
         self.h2conn.send_headers(stream_id, headers, end_stream=end_stream)
         self._sent_streams[stream_id] = self.loop.create_future()
         return stream_id
 
+    @contextmanager
+    def corked(self):
+        """Everything written inside leaves in as few TCP segments as possible."""
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            yield
+        finally:
+            self.write_all()
+            # Uncorking sends, the server may answer before this thread runs again
+            self.flush_time = time.time_ns()
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    @property
+    def max_streams(self):
+        return self.h2conn.remote_settings.max_concurrent_streams
+
+    async def wait_for_streams(self, count):
+        """Waits until count more streams may be opened."""
+        while self.connection_open and self.h2conn.open_outbound_streams + count > self.max_streams:
+            self._stream_closed.clear()
+            await self._stream_closed.wait()
+
+    def send_requests(self, requests):
+        """Opens a stream per (headers, body) and writes all of them in one
+        corked write. Bodies larger than the flow-control window are sent
+        as the server opens it."""
+        stream_ids = []
+        with self.corked():
+            for headers, body in requests:
+                stream_id = self.send_request(headers, end_stream=len(body) == 0)
+                if len(body) > 0:
+                    self._pending_data[stream_id] = memoryview(body)
+                    self.send_body(stream_id)
+                stream_ids.append(stream_id)
+
+        for stream_id in stream_ids:
+            self._sent_time[stream_id] = self.flush_time
+        return stream_ids
+
+    def send_body(self, stream_id):
+        data = self._pending_data[stream_id]
+        while len(data) > 0:
+            size = min(len(data), self.h2conn.local_flow_control_window(stream_id), self.h2conn.max_outbound_frame_size)
+            if size == 0:
+                self._pending_data[stream_id] = data
+                return
+            self.h2conn.send_data(stream_id, bytes(data[0:size]), end_stream=size == len(data))
+            data = data[size:]
+        del self._pending_data[stream_id]
+
+    async def wait_for_responses(self, stream_ids, timeout):
+        """(status, response time - send time in ns, body) per stream,
+        None for streams without response in time. The send time is taken
+        in user space right before the write is uncorked, so with kernel
+        receive timestamps both ends are CLOCK_REALTIME but only the
+        receive end is taken by the kernel: the time includes the send
+        system call and excludes event loop delays on receiving."""
+        futures = [self._sent_streams[x] for x in stream_ids]
+        _, pending = await asyncio.wait(futures, timeout=timeout)
+        for fut in pending:
+            fut.set_result(None)
+
+        responses = []
+        for stream_id in stream_ids:
+            info = self._sent_streams.pop(stream_id).result()
+            sent_time = self._sent_time.pop(stream_id, None)
+            if info is None:
+                responses.append(None)
+            else:
+                status, resp_time, data = info
+                responses.append((status, resp_time - sent_time, data))
+        return responses
+
     def send_request_pair(self, headers1: list, headers2: list, data1: str = '', data2: str =''):
         max_payload_len = 1200
 
@@ -91,8 +323,8 @@ class H2Protocol(asyncio.Protocol):
 
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
         # overestimation of headers: not taking HPACK into account
-        headers1_len = len(' '.join(['%s: %s' % x for x in headers1]))
-        headers2_len = len(' '.join(['%s: %s' % x for x in headers2]))
+        headers1_len = headers_length(headers1)
+        headers2_len = headers_length(headers2)
         if headers2_len > max_payload_len:
             self.logger.warning('Size of headers of second request may be larger than what fits in a single TCP packet - both request may not arrive at the same time')
 
@@ -133,7 +365,7 @@ class H2Protocol(asyncio.Protocol):
         return stream1, stream2
 
     def receive_response(self, headers, stream_id):
-        resp_time = time.time_ns()
+        resp_time = self._arrival_time if self._arrival_time is not None else time.time_ns()
         status_headers = list(filter(lambda x: x[0] == b':status', headers))
         status = '-1'
         if len(status_headers) == 1:
@@ -147,11 +379,25 @@ class H2Protocol(asyncio.Protocol):
         if stream_id not in self._received_header:
             return
 
-        status, resp_time = self._received_header[stream_id]
-        del self._received_header[stream_id]
-        self._sent_streams[stream_id].set_result((status, resp_time, data))
+        self._received_data.setdefault(stream_id, bytearray()).extend(data)
+
+    def end_stream(self, stream_id, reset=False):
+        self._stream_closed.set()
+        header = self._received_header.pop(stream_id, None)
+        data = self._received_data.pop(stream_id, bytearray())
+
+        fut = self._sent_streams.get(stream_id)
+        if fut is None or fut.done():
+            return
+        if reset or header is None:
+            fut.set_result(None)
+        else:
+            status, resp_time = header
+            fut.set_result((status, resp_time, bytes(data)))
 
     async def wait_for_all_responses(self, timeout):
+        if len(self._sent_streams) == 0:
+            return
         done, pending = await asyncio.wait([x for x in self._sent_streams.values()], timeout=timeout)
         for fut in pending:
             fut.set_result(None)
@@ -161,7 +407,7 @@ class H2Protocol(asyncio.Protocol):
         resp_info2 = self._sent_streams[stream_id2].result()
         if resp_info1 is None or resp_info2 is None:
             return None
-        # diff,status1,status2
+        # diff,status1,status2, 0 if both share a kernel timestamp (a tie)
         return resp_info2[1] - resp_info1[1], resp_info1[0], resp_info2[0], resp_info1[2], resp_info2[2]
 
     def remove_all_unacknowleged_streams(self):
@@ -170,6 +416,20 @@ class H2Protocol(asyncio.Protocol):
                 fut.set_result(None)
 
 
+@functools.lru_cache(maxsize=256)
+def padding_params(query: str, num: int):
+    """num distinct query parameter names that are not used in query."""
+    exclude_params = parse_qs(query).keys()
+    new_params = []
+    charset = string.ascii_lowercase + string.digits
+    param_length = 1
+    while len(new_params) < num:
+        new_params.extend([''.join(x) for x in itertools.combinations_with_replacement(charset, param_length) if ''.join(x) not in exclude_params])
+        param_length += 1
+    new_params = new_params[:num]
+    return '&'.join(new_params)
+
+
 class H2Request:
     def __init__(self, method: str, url: str, headers: dict = None, data: str = ''):
         self.method = method
@@ -178,6 +438,7 @@ class H2Request:
         self.data = data
         self.headers = headers if headers is not None else {}
         self.num_padding_params = 0
+        self._headers_cache = {}
 
     def set_url(self, url: str):
         self.url = url
@@ -197,7 +458,19 @@ class H2Request:
     def remove_header(self, key: str):
         del self.headers[key]
 
-    def get_request_headers(self):
+    def get_request_headers(self, never_indexed=False):
+        """Header list of the request, memoized per padding and header
+        state. never_indexed headers are encoded the same on every
+        connection, so their HPACK blocks are cached by CachingEncoder."""
+        key = (self.num_padding_params, never_indexed, self.method, self.url, tuple(self.headers.items()))
+        headers = self._headers_cache.get(key)
+        if headers is None:
+            if len(self._headers_cache) >= 64:
+                self._headers_cache.clear()
+            headers = self._headers_cache[key] = self._build_headers(never_indexed)
+        return headers
+
+    def _build_headers(self, never_indexed):
         path = self.path
         if self.query != '':
             path += '?' + self.query
@@ -211,26 +484,21 @@ class H2Request:
             (':path', path),
         ]
         for k, v in self.headers.items():
-            headers.append((k, v))
-        return headers
+            headers.append((k.lower(), v))
+
+        if never_indexed:
+            return tuple(NeverIndexedHeaderTuple(k.encode('utf-8'), v.encode('utf-8')) for k, v in headers)
+        return tuple(headers)
 
     def set_num_padding_params(self, num: int):
         self.num_padding_params = num
 
     def gen_params(self):
-        exclude_params = parse_qs(self.query).keys()
-        new_params = []
-        charset = string.ascii_lowercase + string.digits
-        param_length = 1
-        while len(new_params) < self.num_padding_params:
-            new_params.extend([''.join(x) for x in itertools.combinations_with_replacement(charset, param_length) if ''.join(x) not in exclude_params])
-            param_length += 1
-        new_params = new_params[:self.num_padding_params]
-        return '&'.join(new_params)
+        return padding_params(self.query, self.num_padding_params)
 
 
 class H2Time:
-    def __init__(self, request1: H2Request, request2: H2Request, sequential=True, num_request_pairs=50, inter_request_time_ms=10, num_padding_params=40, timeout=5):
+    def __init__(self, request1: H2Request, request2: H2Request, sequential=True, num_request_pairs=50, inter_request_time_ms=10, num_padding_params=40, timeout=5, protocol: H2Protocol = None, window: int = None, kernel_timestamps=False):
         self.request1 = request1
         self.request2 = request2
         self.scheme = request1.scheme
@@ -238,50 +506,60 @@ class H2Time:
         self.port = request1.port
         self.loop = asyncio.get_event_loop()
         self._settings = {SettingsFrame.HEADER_TABLE_SIZE: 4096}
-        self.protocol: H2Protocol = None
+        # A given protocol is borrowed, e.g. from an H2ConnectionPool, and stays open
+        self.protocol: H2Protocol = protocol
+        self._owns_protocol = protocol is None
+        self.kernel_timestamps = kernel_timestamps
         self.sequential = sequential
+        # At most window pairs without responses, overrides sequential
+        self.window = window
         self.num_request_pairs = num_request_pairs
         self.inter_request_time_ms = inter_request_time_ms
         self.num_padding_params = num_padding_params
         self.sent_requests = []
+        self.sent_times = []
         self.timeout = timeout
         self._swap = 0
 
     async def __aenter__(self):
-        _, self.protocol = await self.loop.create_connection(
-            lambda: H2Protocol(self._settings, self.loop), self.host, self.port, ssl=H2Time._get_http2_ssl_context() if self.scheme == 'https' else None, family=socket.AF_INET
-        )
+        if self._owns_protocol:
+            self.protocol = await open_connection(self.host, self.port, self.scheme, self._settings, wait_ready=False, kernel_timestamps=self.kernel_timestamps)
         return self
 
     async def __aexit__(self, *exc):
         await self.terminate()
 
     async def terminate(self):
-        if self.protocol:
+        if self.protocol and self._owns_protocol:
             await self.protocol.terminate()
-            self.protocol = None
+        self.protocol = None
 
     def send_request_pair(self):
+        # Alternates which request goes first, results keep request1, request2 order
         self._swap = 0 if self._swap == 1 else 1
 
+        first, second = self.request1, self.request2
         if self._swap == 1:
-            self.request1, self.request2 = self.request2, self.request1
+            first, second = second, first
 
-        self.request1.set_num_padding_params(self.num_padding_params)
+        first.set_num_padding_params(self.num_padding_params)
 
-        headers1 = self.request1.get_request_headers()
-        headers2 = self.request2.get_request_headers()
-        stream_id1, stream_id2 = self.protocol.send_request_pair(headers1, headers2, self.request1.data, self.request2.data)
+        headers1 = first.get_request_headers(never_indexed=True)
+        headers2 = second.get_request_headers(never_indexed=True)
+        stream_id1, stream_id2 = self.protocol.send_request_pair(headers1, headers2, first.data, second.data)
+        self.sent_times.append(time.perf_counter_ns())
         if self._swap == 1:
             self.sent_requests.append((stream_id2, stream_id1))
         else:
             self.sent_requests.append((stream_id1, stream_id2))
 
-        self.request1.set_num_padding_params(0)
+        first.set_num_padding_params(0)
 
     @staticmethod
     def _get_http2_ssl_context():
-        ctx = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
+        # Without certificate checks, like create_default_context() minus
+        # the CA loading, so the context can resume sessions
+        ctx = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
         ctx.options |= (
                 ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
         )
@@ -292,19 +570,399 @@ class H2Time:
         ctx.verify_mode = ssl.CERT_NONE
         try:
             ctx.set_npn_protocols(["h2", "http/1.1"])
-        except NotImplementedError:
+        except (NotImplementedError, AttributeError):
+            # Builds without NPN, e.g. against OpenSSL 3
             pass
         return ctx
 
     async def run_attack(self):
-        for _ in range(self.num_request_pairs):
-            time.sleep(self.inter_request_time_ms / 1000)
+        # Pairs are sent at fixed points in time from the start on, so
+        # waiting for responses or a late wakeup does not shift later pairs
+        interval_ns = int(self.inter_request_time_ms * 1e6)
+        start_ns = time.perf_counter_ns()
+
+        for n in range(self.num_request_pairs):
+            if self.window is not None:
+                await self.wait_for_window(self.window)
+            if interval_ns > 0:
+                await sleep_until(start_ns + (n + 1) * interval_ns)
             if not self.protocol.connection_open:
                 break
             self.send_request_pair()
-            if self.sequential:
+            if self.sequential and self.window is None:
                 await self.protocol.wait_for_all_responses(self.timeout)
 
         await self.protocol.wait_for_all_responses(self.timeout)
+        return self.collect_results()
+
+    async def wait_for_window(self, window):
+        """Waits until fewer than window sent pairs lack a response."""
+        while True:
+            outstanding = [x for pair in self.sent_requests for x in self.protocol.response_futures(pair) if not x.done()]
+            if len(outstanding) < 2 * window:
+                return
+            done, _ = await asyncio.wait(outstanding, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                # Timed out, the pair counts as lost like in wait_for_all_responses
+                for fut in outstanding:
+                    fut.set_result(None)
+
+    def collect_results(self):
         results = list(filter(lambda x: x is not None, map(lambda x: self.protocol.get_response_info(*x), self.sent_requests)))
+        if not self._owns_protocol:
+            self.protocol.discard_streams([x for pair in self.sent_requests for x in pair])
         return results
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """Client context that offers session to the server on every new
+    connection. asyncio has no way to pass a session to
+    create_connection(), but it wraps every connection with wrap_bio()."""
+
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+class TLSTarget:
+    """TLS state shared by all connections to one host and port: a single
+    context, the newest session ticket to resume and the ALPN protocol the
+    server chose. With it a new connection costs an abbreviated handshake
+    instead of building a context, loading ciphers and a full key exchange.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.context = H2Time._get_http2_ssl_context()
+        self.alpn_protocol = None
+        # Metrics
+        self.handshakes = 0
+        self.resumed = 0
+
+    def handshake(self, ssl_object, alpn_protocol):
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        if self.alpn_protocol is None and alpn_protocol == 'h2':
+            # Nothing else is used, so stop offering http/1.1
+            self.context.set_alpn_protocols(['h2'])
+        self.alpn_protocol = alpn_protocol
+
+    def remember(self, ssl_object):
+        """Keeps the session of ssl_object once it holds a ticket, TLS 1.3
+        servers send it after the handshake. Returns whether it did."""
+        session = ssl_object.session
+        if session is None or not session.has_ticket:
+            return False
+        self.context.session = session
+        return True
+
+    def check(self):
+        """Fails early for targets known to not speak HTTP/2."""
+        if self.alpn_protocol not in (None, 'h2'):
+            raise RuntimeError("The server does not support HTTP/2")
+
+    @property
+    def resumption_rate(self):
+        return self.resumed / self.handshakes if self.handshakes > 0 else 0.0
+
+    def __repr__(self):
+        return f'TLSTarget({self.host}:{self.port}, {self.alpn_protocol}, {self.handshakes} handshakes, {self.resumption_rate:.1%} resumed)'
+
+
+_tls_targets = {}
+
+
+def tls_target(host, port):
+    """The TLSTarget of host and port, created on first use."""
+    key = (host, port)
+    target = _tls_targets.get(key)
+    if target is None:
+        target = _tls_targets[key] = TLSTarget(host, port)
+    return target
+
+
+class H2ConnectionPool:
+    """Warm H2Protocol connections to one target that pair races borrow and
+    return, so a race costs no TCP, SETTINGS or TLS handshake.
+
+    Returned connections are kept while they are usable (see
+    H2Protocol.usable) and have no streams in flight. Connections that were
+    idle for longer than ping_after seconds are checked with a PING before
+    they are handed out, broken ones and ones that received a GOAWAY are
+    replaced by new connections.
+    """
+
+    def __init__(self, host, port, scheme='http', size=4, settings=None, ping_after=1.0, kernel_timestamps=False):
+        self.host = host
+        self.port = port
+        self.scheme = scheme
+        self.kernel_timestamps = kernel_timestamps
+        self.size = max(1, size)
+        self.settings = settings
+        self.ping_after = ping_after
+        self._idle = deque()
+        # Metrics
+        self.borrowed = 0
+        self.reused = 0
+        self.opened = 0
+        self.replaced = 0
+
+    async def _open(self):
+        protocol = await open_connection(self.host, self.port, self.scheme, self.settings, kernel_timestamps=self.kernel_timestamps)
+        self.opened += 1
+        return protocol
+
+    async def warm(self):
+        """Opens connections until size are idle."""
+        missing = self.size - len(self._idle)
+        if missing > 0 and self.scheme == 'https' and tls_target(self.host, self.port).context.session is None:
+            # The first handshake gets the session ticket the others resume
+            self._idle.append((await self._open(), time.monotonic()))
+            missing -= 1
+        if missing > 0:
+            protocols = await asyncio.gather(*[self._open() for _ in range(missing)])
+            self._idle.extend((x, time.monotonic()) for x in protocols)
+
+    async def acquire(self):
+        self.borrowed += 1
+        while self._idle:
+            protocol, idle_since = self._idle.popleft()
+            if protocol.usable and (time.monotonic() - idle_since < self.ping_after or await protocol.ping()):
+                self.reused += 1
+                return protocol
+            self.replaced += 1
+            await self._discard(protocol)
+        return await self._open()
+
+    async def release(self, protocol):
+        if protocol.usable and protocol.outstanding == 0 and len(self._idle) < self.size:
+            self._idle.append((protocol, time.monotonic()))
+        else:
+            self.replaced += 1
+            await self._discard(protocol)
+
+    @asynccontextmanager
+    async def connection(self):
+        protocol = await self.acquire()
+        try:
+            yield protocol
+        finally:
+            await self.release(protocol)
+
+    async def _discard(self, protocol):
+        if protocol.connection_open:
+            protocol.transport.close()
+
+    async def close(self):
+        while self._idle:
+            protocol, _ = self._idle.popleft()
+            if protocol.connection_open:
+                await protocol.terminate()
+
+    @property
+    def reuse_rate(self):
+        return self.reused / self.borrowed if self.borrowed > 0 else 0.0
+
+    def __repr__(self):
+        return f'H2ConnectionPool({self.borrowed} borrowed, {self.reuse_rate:.1%} reused, {self.opened} opened, {self.replaced} replaced)'
+
+
+class TimestampingTransport(asyncio.Transport):
+    """Plain TCP transport that reads with recvmsg and SO_TIMESTAMPNS and
+    passes every read to H2Protocol.data_received_at together with the
+    kernel receive time of its last TCP segment. Response times then
+    reflect the wire instead of when the loop got around to parsing them.
+
+    Segments that are already queued when the socket is read share one
+    timestamp, so the transport reads as soon as the socket is readable.
+    """
+
+    max_read_size = 256 * 1024
+
+    def __init__(self, loop, sock, protocol):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._buffer = bytearray()
+        self._closing = False
+        self._connection_lost = False
+        self._extra = {'socket': sock, 'peername': sock.getpeername(), 'sockname': sock.getsockname()}
+
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        self._ancillary_size = socket.CMSG_SPACE(TIMESPEC.size)
+
+        protocol.connection_made(self)
+        loop.add_reader(sock.fileno(), self._read_ready)
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def _read_ready(self):
+        try:
+            data, ancdata, _, _ = self._sock.recvmsg(self.max_read_size, self._ancillary_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._force_close(exc)
+            return
+
+        if not data:
+            self._force_close(None)
+            return
+
+        arrival_time = None
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+                sec, nsec = TIMESPEC.unpack(cdata[0:TIMESPEC.size])
+                arrival_time = sec * 1_000_000_000 + nsec
+        self._protocol.data_received_at(data, arrival_time)
+
+    def write(self, data):
+        if self._closing or len(data) == 0:
+            return
+
+        if len(self._buffer) == 0:
+            try:
+                sent = self._sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as exc:
+                self._force_close(exc)
+                return
+            if sent == len(data):
+                return
+            data = memoryview(data)[sent:]
+            self._loop.add_writer(self._sock.fileno(), self._write_ready)
+
+        self._buffer.extend(data)
+
+    def _write_ready(self):
+        try:
+            sent = self._sock.send(self._buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._force_close(exc)
+            return
+
+        del self._buffer[0:sent]
+        if len(self._buffer) == 0:
+            self._loop.remove_writer(self._sock.fileno())
+            if self._closing:
+                self._call_connection_lost(None)
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        if len(self._buffer) == 0:
+            self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self._force_close(None)
+
+    def _force_close(self, exc):
+        if self._connection_lost:
+            return
+        self._closing = True
+        self._buffer.clear()
+        self._loop.remove_reader(self._sock.fileno())
+        self._loop.remove_writer(self._sock.fileno())
+        self._loop.call_soon(self._call_connection_lost, exc)
+
+    def _call_connection_lost(self, exc):
+        if self._connection_lost:
+            return
+        self._connection_lost = True
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+
+
+async def open_connection(host, port, scheme='http', settings=None, wait_ready=True, kernel_timestamps=False):
+    """Opens an H2Protocol connection, by default once the server sent its
+    SETTINGS. kernel_timestamps stamps responses with the kernel receive
+    time (TimestampingTransport), only for plain TCP."""
+    loop = asyncio.get_running_loop()
+    if settings is None:
+        settings = {SettingsFrame.HEADER_TABLE_SIZE: 4096}
+
+    if kernel_timestamps:
+        if scheme == 'https':
+            raise ValueError('Kernel receive timestamps need plain TCP, not https')
+
+        infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, infos[0][4])
+        except BaseException:
+            sock.close()
+            raise
+        protocol = H2Protocol(settings, loop)
+        TimestampingTransport(loop, sock, protocol)
+    elif scheme == 'https':
+        # One context and session per target instead of a full handshake each time
+        target = tls_target(host, port)
+        target.check()
+
+        def factory():
+            protocol = H2Protocol(settings, loop)
+            protocol.tls_target = target
+            return protocol
+
+        _, protocol = await loop.create_connection(factory, host, port, ssl=target.context, server_hostname=host, family=socket.AF_INET)
+    else:
+        _, protocol = await loop.create_connection(lambda: H2Protocol(settings, loop), host, port, family=socket.AF_INET)
+    if wait_ready:
+        await protocol.ready()
+    return protocol
+
+
+# Waits shorter than this end in a spin on the event loop instead of a timer
+SPIN_NS = 1_000_000
+
+
+async def sleep_until(deadline_ns, spin_ns=SPIN_NS):
+    """Sleeps until time.perf_counter_ns() reaches deadline_ns without
+    blocking the event loop. A coarse asyncio.sleep covers all but the last
+    spin_ns, which is spent yielding to the loop until the deadline, so
+    responses keep being processed while waiting and the wakeup is not
+    bound to the timer resolution of the loop."""
+    remaining = deadline_ns - time.perf_counter_ns()
+    if remaining > spin_ns:
+        await asyncio.sleep((remaining - spin_ns) / 1e9)
+
+    while time.perf_counter_ns() < deadline_ns:
+        await asyncio.sleep(0)
+
+
+async def run_attacks(attacks, timeout=5):
+    """Runs several H2Time attacks on the protocol they share. Each round
+    sends one request pair of every attack back-to-back, waiting only when
+    the stream limit of the server is reached, and then waits for all
+    responses. Returns the results of every attack like run_attack."""
+    if len(attacks) == 0:
+        return []
+
+    protocol = attacks[0].protocol
+    for n in range(max(x.num_request_pairs for x in attacks)):
+        for attack in attacks:
+            if n >= attack.num_request_pairs or not protocol.connection_open:
+                continue
+            await protocol.wait_for_streams(2)
+            attack.send_request_pair()
+
+    await protocol.wait_for_all_responses(timeout)
+    return [x.collect_results() for x in attacks]
@@ -0,0 +1,93 @@
+import sys
+import time
+import atexit
+import builtins
+import importlib
+
+
+class LazyModule:
+    """Module that is only imported on first attribute access, so scripts
+    pay for heavy dependencies (pandas, aiohttp, seaborn, ...) only in the
+    commands and backends that use them."""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+class ImportProfiler:
+    """Measures the time spent importing every module by wrapping
+    builtins.__import__. Self time excludes nested imports, so the report
+    shows which modules are actually expensive."""
+
+    def __init__(self):
+        self.records = {}
+        self._stack = []
+        self._import = None
+
+    @classmethod
+    def from_argv(cls, argv, flag='--import-profile'):
+        """Starts a profiler that reports on exit if flag is in argv."""
+        if flag not in argv:
+            return None
+
+        profiler = cls()
+        profiler.start()
+        atexit.register(profiler.report)
+        return profiler
+
+    def start(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self._profiled_import
+
+    def stop(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _profiled_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # Only first imports are measured, later ones are dict lookups
+        if level > 0 or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += total
+            self.records[name] = (total - nested, total)
+
+    def report(self, limit=25, file=None):
+        self.stop()
+        file = file or sys.stderr
+
+        records = sorted(self.records.items(), key=lambda x: x[1][0], reverse=True)
+        total = sum(x[0] for _, x in records)
+
+        print(f'{"Module":40} {"self ms":>10} {"cumulative ms":>14}', file=file)
+        for name, (self_time, cumulative) in records[0:limit]:
+            print(f'{name:40} {self_time * 1000:10.1f} {cumulative * 1000:14.1f}', file=file)
+        print(f'{len(records)} modules imported in {total * 1000:.1f} ms', file=file)
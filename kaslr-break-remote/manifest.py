@@ -0,0 +1,66 @@
+import os
+import json
+
+
+MANIFEST_DIR = '.manifests'
+
+
+def parse_server_manifest(body):
+    """Parses a /manifest response into (instance id, {offset: tag})."""
+    lines = body.decode('ascii').split()
+    if len(lines) == 0:
+        raise ValueError('Empty manifest')
+
+    tags = {}
+    for line in lines[1:]:
+        offset, tag = line.split(',', 1)
+        tags[int(offset)] = tag
+
+    return lines[0], tags
+
+
+class UploadManifest:
+    """Content tags of the pages a server holds, per host and port.
+
+    The server reports the tags it received with the pages (/manifest)
+    together with an instance id that changes when it restarts, so only
+    missing or changed pages need to be uploaded. The manifest keeps the
+    last known state of a target on disk between runs. Only if trust_local
+    is set, that state stands in for servers that report no manifest.
+    """
+
+    def __init__(self, path, trust_local=False):
+        self.path = path
+        self.trust_local = trust_local
+        self.instance = None
+        self.tags = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.instance = data.get('instance')
+            self.tags = {int(x): tag for x, tag in data.get('tags', {}).items()}
+
+    @classmethod
+    def for_target(cls, host, port, directory=MANIFEST_DIR, trust_local=False):
+        return cls(os.path.join(directory, f'{host}_{port}.json'), trust_local)
+
+    def update(self, instance, tags):
+        """Replaces the state with the one reported by the server."""
+        self.instance = instance
+        self.tags = dict(tags)
+
+    def record(self, tags, failed=()):
+        self.tags.update(tags)
+        for offset in failed:
+            self.tags.pop(offset, None)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'instance': self.instance, 'tags': {str(x): tag for x, tag in sorted(self.tags.items())}}, f)
+        os.replace(tmp_path, self.path)
@@ -1,13 +1,20 @@
 import asyncio
 import threading
-import pyshark
+import ctypes
+import socket
+import struct
 import re
 import os
 import signal
-import pandas as pd
-import numpy as np
+from collections import deque
 from queue import Queue
 from pprint import pprint
+from lazyimport import lazy_import
+
+# Only the pyshark engine needs them
+pyshark = lazy_import('pyshark')
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
 
 
 class CapturePySharkThreadHttp(threading.Thread):
@@ -196,3 +203,338 @@ class CapturePySharkThreadHttp(threading.Thread):
                 os.kill(pid, signal.SIGKILL)
             except Exception as e:
                 pass
+
+
+# Native capture engine: frames from an AF_PACKET socket or a pcap stream,
+# only the Ethernet, IPv4 and TCP headers and the HTTP message heads are parsed
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+SO_ATTACH_FILTER = 26
+# Linux values, Python only exports SO_TIMESTAMPNS from 3.12 on
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@qq')
+SO_RCVBUFFORCE = 33
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+# Pipelined requests share segments, so whole frames are needed to see all
+# request lines (loopback frames are up to 64 KiB)
+SNAPLEN = 65535 + 14
+
+IPV4_HEADER = struct.Struct('!BxHHHBBH4s4s')
+TCP_HEADER = struct.Struct('!HHIIBB')
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+LINKTYPE_ETHERNET = 1
+
+TRIGGER_PATH = b'/set-byte/'
+CONTENT_LENGTH = re.compile(rb'(?i)\r\ncontent-length:\s*(\d+)')
+
+
+def tcp_port_filter(port, snaplen=SNAPLEN):
+    """Classic BPF program for 'ip and tcp port <port>' on Ethernet, as
+    tcpdump -dd compiles it, that truncates accepted frames to snaplen."""
+    reject = 12
+    return [
+        (0x28, 0, 0, 12),                   # ldh [12]
+        (0x15, 0, reject - 2, ETH_P_IP),    # jeq #0x800
+        (0x30, 0, 0, 23),                   # ldb [23]
+        (0x15, 0, reject - 4, 6),           # jeq #tcp
+        (0x28, 0, 0, 20),                   # ldh [20]
+        (0x45, reject - 6, 0, 0x1fff),      # jset #0x1fff, no fragments
+        (0xb1, 0, 0, 14),                   # ldxb 4*([14]&0xf)
+        (0x48, 0, 0, 14),                   # ldh [x + 14], source port
+        (0x15, 2, 0, port),                 # jeq #port
+        (0x48, 0, 0, 16),                   # ldh [x + 16], destination port
+        (0x15, 0, 1, port),                 # jeq #port
+        (0x06, 0, 0, snaplen),              # ret #snaplen
+        (0x06, 0, 0, 0),                    # ret #0
+    ]
+
+
+def attach_filter(sock, program):
+    code = b''.join(struct.pack('HBBI', *x) for x in program)
+    buffer = ctypes.create_string_buffer(code)
+    # struct sock_fprog, the kernel copies the program
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class PacketSocketSource:
+    """(timestamp in ns, frame) of every TCP frame to or from port on
+    interface, read from an AF_PACKET socket with the kernel receive
+    timestamps. On loopback every frame is seen twice, the outgoing copy is
+    dropped. Bursts are buffered in the kernel, up to buffer_size bytes."""
+
+    def __init__(self, interface, port, timeout=0.2, buffer_size=32 * 2**20):
+        self._socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        self.drops = 0
+        try:
+            attach_filter(self._socket, tcp_port_filter(port))
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            try:
+                # Beyond net.core.rmem_max, needs CAP_NET_ADMIN
+                self._socket.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, buffer_size)
+            except OSError:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+            self._socket.bind((interface, 0))
+        except OSError:
+            self._socket.close()
+            raise
+        # stop() is checked between timeouts
+        self._socket.settimeout(timeout)
+
+    def frames(self, stopping):
+        ancillary_size = socket.CMSG_SPACE(TIMESPEC.size)
+        while not stopping():
+            try:
+                frame, ancillary, _, address = self._socket.recvmsg(SNAPLEN, ancillary_size)
+            except socket.timeout:
+                self.update_drops()
+                continue
+            except OSError:
+                # Closed by kill()
+                return
+
+            if address[2] == PACKET_OUTGOING and address[3] == ARPHRD_LOOPBACK:
+                continue
+
+            timestamp = None
+            for level, kind, data in ancillary:
+                if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+                    seconds, nanoseconds = TIMESPEC.unpack(data[0:TIMESPEC.size])
+                    timestamp = seconds * 1_000_000_000 + nanoseconds
+            yield timestamp, frame
+
+        self.update_drops()
+
+    def update_drops(self):
+        """Adds the frames the kernel dropped since the last call to drops."""
+        try:
+            _, drops = struct.unpack('II', self._socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+        except OSError:
+            # Closed by kill()
+            return self.drops
+        self.drops += drops
+        return self.drops
+
+    def close(self):
+        self._socket.close()
+
+
+class PcapStreamSource:
+    """(timestamp in ns, frame) of the records of a pcap stream with Ethernet
+    frames, e.g. a file or the output of tcpdump -U -w - 'tcp port 6666'.
+    Both microsecond and nanosecond pcap files are supported, pcapng is not.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        header = self._read(PCAP_HEADER.size)
+        if header is None:
+            raise ValueError('Empty pcap stream')
+
+        magic = struct.unpack('<I', header[0:4])[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            order = '<'
+        elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+            order = '>'
+        else:
+            raise ValueError(f'Not a pcap stream (magic {magic:#x})')
+        self._record = struct.Struct(order + PCAP_RECORD.format[1:])
+        _, _, _, _, _, _, linktype = struct.unpack(order + PCAP_HEADER.format[1:], header)
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError(f'Unsupported pcap link type {linktype}, only Ethernet')
+        self._fraction = 1 if magic in (0xa1b23c4d, 0x4d3cb2a1) else 1000
+
+    def _read(self, size):
+        data = self._stream.read(size)
+        while data and len(data) < size:
+            more = self._stream.read(size - len(data))
+            if not more:
+                break
+            data += more
+        return data if len(data) == size else None
+
+    def frames(self, stopping):
+        while not stopping():
+            header = self._read(self._record.size)
+            if header is None:
+                return
+            seconds, fraction, length, _ = self._record.unpack(header)
+            frame = self._read(length)
+            if frame is None:
+                return
+            yield seconds * 1_000_000_000 + fraction * self._fraction, frame
+
+    def close(self):
+        self._stream.close()
+
+
+class HttpFlow:
+    """State of one TCP connection: the time of its first and previous
+    frame, its requests without responses (None for requests that are not
+    triggers) and, per direction, the body bytes still to come."""
+
+    def __init__(self, timestamp):
+        self.first = timestamp
+        self.previous = timestamp
+        self.requests = deque()
+        self.body_left = [0, 0]
+
+
+class HttpTriggerTracker:
+    """Matches trigger requests (POST /set-byte/<offset>) with their
+    responses per TCP connection and returns the same records as
+    CapturePySharkThreadHttp, with integer nanosecond timestamps:
+    Timestamp is the time from the request to the response frame, TS First
+    Frame and TS Prev Frame the time since the first and the previous frame
+    of the connection (tcp.time_relative and tcp.time_delta of tshark).
+
+    HTTP/1.1 responses arrive in request order, so a response belongs to the
+    oldest request of its connection. Messages are delimited by their
+    Content-Length, so pipelined requests and responses that share a
+    segment are all seen. Retransmissions are not detected.
+    """
+
+    def __init__(self, tcp_port):
+        self.tcp_port = tcp_port
+        self.flows = {}
+        self.frames = 0
+
+    def feed(self, timestamp, frame):
+        """Returns the records of the triggers whose responses start in frame."""
+        self.frames += 1
+
+        offset = 14
+        ethertype = (frame[12] << 8) | frame[13]
+        if ethertype == ETH_P_8021Q:
+            ethertype = (frame[16] << 8) | frame[17]
+            offset = 18
+        if ethertype != ETH_P_IP:
+            return []
+
+        version_ihl, total_length, _, fragment, _, protocol, _, source, destination = IPV4_HEADER.unpack_from(frame, offset)
+        if protocol != 6 or fragment & 0x1fff:
+            return []
+        ip_end = offset + total_length
+        offset += (version_ihl & 0x0f) * 4
+
+        source_port, destination_port, _, _, data_offset, flags = TCP_HEADER.unpack_from(frame, offset)
+        offset += (data_offset >> 4) * 4
+        # The frame may be cut off by the snap length, the IP length is not
+        length = ip_end - offset
+        payload = frame[offset:ip_end]
+
+        if destination_port == self.tcp_port:
+            key, from_client = (source, source_port), True
+        elif source_port == self.tcp_port:
+            key, from_client = (destination, destination_port), False
+        else:
+            return []
+
+        flow = self.flows.get(key)
+        if flow is None or (from_client and flags & (TCP_SYN | TCP_ACK) == TCP_SYN):
+            # A new connection, possibly on a reused port
+            flow = self.flows[key] = HttpFlow(timestamp)
+        previous = flow.previous
+        flow.previous = timestamp
+
+        records = []
+        for head in self._heads(flow, int(not from_client), payload, length):
+            if from_client:
+                flow.requests.append(self._trigger(head, timestamp))
+            elif head.startswith(b'HTTP/') and flow.requests:
+                request = flow.requests.popleft()
+                if request is not None:
+                    records.append({
+                        'Offset': request[0],
+                        'Timestamp': timestamp - request[1],
+                        'TS First Frame': timestamp - flow.first,
+                        'TS Prev Frame': timestamp - previous,
+                        })
+        return records
+
+    @staticmethod
+    def _heads(flow, direction, payload, length):
+        """Header blocks of the messages that start in payload."""
+        pos = 0
+        while pos < length:
+            body_left = flow.body_left[direction]
+            if body_left > 0:
+                skipped = min(body_left, length - pos)
+                flow.body_left[direction] -= skipped
+                pos += skipped
+                continue
+
+            end = payload.find(b'\r\n\r\n', pos)
+            if end < 0:
+                # Header split over segments or cut off, lost
+                return
+            head = payload[pos:end]
+            content_length = CONTENT_LENGTH.search(head)
+            flow.body_left[direction] = int(content_length.group(1)) if content_length else 0
+            pos = end + 4
+            yield head
+
+    @staticmethod
+    def _trigger(head, timestamp):
+        """(offset, timestamp) of a trigger request, else None."""
+        request_line = head.split(b'\r\n', 1)[0]
+        parts = request_line.split(b' ')
+        if len(parts) < 2 or not parts[1].startswith(TRIGGER_PATH):
+            return None
+        digits = re.match(rb'\d+', parts[1][len(TRIGGER_PATH):])
+        return (int(digits.group()), timestamp) if digits else None
+
+
+class CapturePacketThreadHttp(threading.Thread):
+    """In-process replacement of CapturePySharkThreadHttp: reads frames of
+    tcp_port from an AF_PACKET socket on interface, or from the pcap stream
+    pcap if given, and puts the records of HttpTriggerTracker into
+    measurements. Needs CAP_NET_RAW for live captures, no tshark. Frames the
+    kernel dropped are counted in drops and reported when the capture ends.
+    """
+
+    def __init__(self, group=None, target=None, name=None, interface="enp7s0", tcp_port=6666, args=(), kwargs={}, backend=None, pcap=None):
+        threading.Thread.__init__(self, group, target, name, args=args, kwargs=kwargs)
+        self.backend = backend
+        if pcap is not None:
+            self._source = PcapStreamSource(pcap)
+        else:
+            self._source = PacketSocketSource(interface, tcp_port)
+        self.tracker = HttpTriggerTracker(tcp_port)
+        self._stopping = False
+        self.measurements = Queue()
+
+    def run(self):
+        self._stopping = False
+
+        for timestamp, frame in self._source.frames(lambda: self._stopping):
+            try:
+                records = self.tracker.feed(timestamp, frame)
+            except (IndexError, struct.error):
+                # Truncated frame
+                continue
+            for m in records:
+                self.measurements.put(m)
+
+        if self.drops > 0:
+            print(f'Capture: the kernel dropped {self.drops} frames, measurements may be missing')
+
+    @property
+    def drops(self):
+        return getattr(self._source, 'drops', 0)
+
+    def stop(self):
+        self._stopping = True
+
+    def kill(self):
+        self._source.close()
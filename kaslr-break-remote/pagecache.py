@@ -0,0 +1,77 @@
+from collections import OrderedDict, deque
+
+
+class PageBufferCache:
+    """Bounded LRU cache of page buffers keyed by KASLR offset.
+
+    Buffers are sparse PageVariants, rendering and encoding them for the
+    wire is left to the service. They are built on first access instead of
+    for all candidates up front, so memory and startup time scale with the
+    offsets an attack actually uploads. A miss builds the requested offset
+    together with the next offsets announced through prefetch() in one
+    vectorized batch.
+    """
+
+    def __init__(self, builder, capacity=64, batch_size=16, prefetch=True):
+        self.builder = builder
+        self.capacity = max(1, capacity)
+        self.batch_size = max(1, min(batch_size, self.capacity))
+        self.prefetch_enabled = prefetch
+
+        self._buffers = OrderedDict()
+        self._pending = deque()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def __contains__(self, offset):
+        return offset in self._buffers
+
+    def __getitem__(self, offset):
+        if offset in self._buffers:
+            self.hits += 1
+            self._buffers.move_to_end(offset)
+            return self._buffers[offset]
+
+        self.misses += 1
+        batch = [offset]
+        while self._pending and len(batch) < self.batch_size:
+            next_offset = self._pending.popleft()
+            if next_offset not in self._buffers and next_offset not in batch:
+                batch.append(next_offset)
+
+        self._build(batch)
+
+        return self._buffers[offset]
+
+    def prefetch(self, offsets):
+        """Announce the next candidate set. The first batch is built right
+        away, the rest when it is accessed."""
+        if not self.prefetch_enabled:
+            return
+
+        self._pending = deque(x for x in offsets if x not in self._buffers)
+
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            batch.append(self._pending.popleft())
+
+        if len(batch) > 0:
+            self._build(batch)
+
+    def tags(self, offsets):
+        return self.builder.tags(offsets)
+
+    def clear(self):
+        self._buffers.clear()
+        self._pending.clear()
+
+    def _build(self, offsets):
+        for offset, buffer in zip(offsets, self.builder.variants(offsets)):
+            self._buffers[offset] = buffer
+            self._buffers.move_to_end(offset)
+
+        while len(self._buffers) > self.capacity:
+            self._buffers.popitem(last=False)
@@ -0,0 +1,73 @@
+import os
+import hashlib
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+
+PAGE_SIZE = 4096
+
+
+def page_hash(content):
+    return hashlib.sha256(content[0:PAGE_SIZE]).hexdigest()
+
+
+class PageStore:
+    """Content-addressed store of page contents.
+
+    Every unique page is held once per process, keyed by its SHA-256, and
+    shared read-only by all profiles that reference it. Page files are
+    remembered by path and modification time, so a file referenced by
+    several profiles is only read once.
+    """
+
+    def __init__(self):
+        self._pages = {}
+        self._files = {}
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, key):
+        return key in self._pages
+
+    def add(self, content, key=None):
+        """Adds a page unless it is already known and returns its key.
+        The buffer is kept without copying."""
+        key = key or page_hash(content)
+        if key not in self._pages:
+            self._pages[key] = memoryview(content)[0:PAGE_SIZE].toreadonly()
+        return key
+
+    def get(self, key):
+        return self._pages[key]
+
+    def clear(self):
+        self._pages.clear()
+        self._files.clear()
+
+    def load_file(self, path, read):
+        """Returns (key, meta) of a page file, calling read(path) only the
+        first time. read returns (content, meta)."""
+        file_key = (os.path.realpath(path), os.stat(path).st_mtime_ns)
+        if file_key not in self._files:
+            content, meta = read(path)
+            self._files[file_key] = (self.add(content), meta)
+        return self._files[file_key]
+
+
+# Shared by all profiles loaded in this process
+store = PageStore()
+
+
+def unique_pages(pages):
+    """Drops pages whose content and pointer slots equal an earlier page,
+    their variants would be identical for every KASLR offset."""
+    seen = set()
+    unique = []
+    for page in pages:
+        key = (page.hash, bytes(np.asarray(page.offsets, dtype=np.uint16)))
+        if key not in seen:
+            seen.add(key)
+            unique.append(page)
+    return unique
@@ -0,0 +1,152 @@
+import asyncio
+from collections import deque
+
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class HTTPError(Exception):
+    pass
+
+
+def build_request(method, path, host, body_length=0, headers=None):
+    """Request line and headers of an HTTP/1.1 request as bytes."""
+    lines = [
+        f'{method} {path} HTTP/1.1',
+        f'Host: {host}',
+        f'Content-Length: {body_length}',
+    ]
+    lines.extend(f'{name}: {value}' for name, value in (headers or {}).items())
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('ascii')
+
+
+class PipelineProtocol(asyncio.Protocol):
+    """HTTP/1.1 client connection that pipelines requests.
+
+    Requests are written as prepared bytes without waiting for earlier
+    responses. Responses arrive in request order and are parsed
+    incrementally into (status, body) for the future of each request.
+    Only Content-Length delimited responses are supported, which is what
+    the pistache app and the stand-in server send.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._response = None
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        error = exc or HTTPError('Connection closed')
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+        self._can_write.set()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    @property
+    def is_open(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    @property
+    def outstanding(self):
+        return len(self._pending)
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    async def drain(self):
+        await self._can_write.wait()
+
+    def send(self, *segments):
+        """Writes one request made of byte segments and returns the future
+        of its response."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self.transport.writelines(segments)
+        return future
+
+    def send_many(self, requests):
+        """Writes several prepared requests back-to-back in one write."""
+        futures = [asyncio.get_running_loop().create_future() for _ in requests]
+        self._pending.extend(futures)
+        self.transport.write(b''.join(requests))
+        return futures
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        await self._closed
+
+    def data_received(self, data):
+        self._buffer += data
+
+        while self._parse_response():
+            pass
+
+        if len(self._buffer) > MAX_HEADER_SIZE and self._response is None:
+            self._fail(HTTPError('Response header too large'))
+
+    def _parse_response(self):
+        if self._response is None:
+            end = self._buffer.find(b'\r\n\r\n')
+            if end < 0:
+                return False
+
+            head = bytes(self._buffer[0:end]).decode('latin-1').split('\r\n')
+            del self._buffer[0:end + 4]
+
+            try:
+                status = int(head[0].split(' ', 2)[1])
+            except (IndexError, ValueError):
+                self._fail(HTTPError(f'Invalid status line {head[0]!r}'))
+                return False
+
+            length = None
+            for line in head[1:]:
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value.strip())
+            if length is None:
+                self._fail(HTTPError('Response without Content-Length'))
+                return False
+
+            self._response = (status, length)
+
+        status, length = self._response
+        if len(self._buffer) < length:
+            return False
+
+        body = bytes(self._buffer[0:length])
+        del self._buffer[0:length]
+        self._response = None
+
+        if self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_result((status, body))
+
+        return True
+
+    def _fail(self, error):
+        self.connection_lost(error)
+        self.close()
+
+
+async def open_connection(host, port):
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_connection(PipelineProtocol, host, port)
+    return protocol
@@ -5,9 +5,12 @@ import os
 import click
 import numpy as np
 import math
-import seaborn as sns
-import matplotlib.pyplot as plt
 from pathlib import Path
+from lazyimport import lazy_import
+
+# Only imported when plotting
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
 
 def filter_outlier(df, column):
     groups = df.groupby('Offset')[column]
@@ -0,0 +1,59 @@
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+
+PAGE_SIZE = 4096
+
+# KERNEL_IMAGE_SIZE on x86_64 with KASLR, kernel text pointers of a page lie
+# within this window above the kernel text mapping
+KERNEL_TEXT_SIZE = 1024 * 1024 * 1024
+# __START_KERNEL_map + KERNEL_IMAGE_SIZE, the module region starts here and is
+# not shifted by the KASLR slide of the kernel image
+KERNEL_TEXT_END = 0xffffffff80000000 + KERNEL_TEXT_SIZE
+
+U64_MASK = (1 << 64) - 1
+
+
+def find_kernel_pointers(page, kernel_text_mapping):
+    """Byte offsets of all 8-byte slots of a page whose value points into
+    the kernel text window starting at kernel_text_mapping. The window ends
+    before the module region."""
+    window = KERNEL_TEXT_SIZE
+    if kernel_text_mapping < KERNEL_TEXT_END:
+        window = min(window, KERNEL_TEXT_END - kernel_text_mapping)
+
+    slots = np.frombuffer(page, dtype='<u8', count=PAGE_SIZE // 8)
+    # Slots below the mapping wrap around and fall out of the window
+    delta = slots - np.uint64(kernel_text_mapping)
+    return (np.flatnonzero(delta < np.uint64(window)) * 8).astype(np.uint16)
+
+
+def get_kernel_offsets(page, page_offsets, kernel_text_mapping):
+    """Pointer minus kernel text mapping for every (possibly unaligned)
+    byte offset, as int64."""
+    page_offsets = np.asarray(page_offsets, dtype=np.intp)
+    page_bytes = np.frombuffer(page, dtype=np.uint8, count=PAGE_SIZE)
+    ptrs = page_bytes[page_offsets[:, None] + np.arange(8)].view('<u8').reshape(-1)
+    return (ptrs - np.uint64(kernel_text_mapping)).view(np.int64)
+
+
+def relocation_table(page, page_offsets, kernel_text_mapping):
+    """Returns (offsets, kernel offsets) as compact arrays. Offsets of -1
+    select the kernel pointers of the page."""
+    if isinstance(page_offsets, int) and page_offsets == -1:
+        page_offsets = find_kernel_pointers(page, kernel_text_mapping)
+    else:
+        invalid = [x for x in page_offsets if not 0 <= x <= PAGE_SIZE - 8]
+        if len(invalid) != 0:
+            raise ValueError(f'Page offsets {invalid} do not hold an 8-byte pointer within the page')
+        page_offsets = np.asarray(page_offsets, dtype=np.uint16)
+
+    return page_offsets, get_kernel_offsets(page, page_offsets, kernel_text_mapping)
+
+
+def to_u64(values):
+    """Kernel offsets modulo 2^64."""
+    if isinstance(values, np.ndarray):
+        return values.astype('<u8')
+    return np.array([x & U64_MASK for x in values], dtype='<u8')
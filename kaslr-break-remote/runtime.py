@@ -0,0 +1,81 @@
+import atexit
+import asyncio
+import threading
+
+
+class AsyncRuntime:
+    """Event loop running in a daemon thread for the whole process.
+
+    All async services share it, so sessions and connections live as long
+    as the service and the calling thread stays free: run() blocks like a
+    normal call, submit() returns a concurrent.futures.Future so strategies
+    can parse captures or compute statistics while triggers are in flight.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                started = threading.Event()
+                self._thread = threading.Thread(target=self._run_loop, args=(started,), name='AsyncRuntime', daemon=True)
+                self._thread.start()
+                started.wait()
+            return self._loop
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(started.set)
+        self._loop.run_forever()
+
+    def in_loop(self):
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        if self.in_loop():
+            raise RuntimeError('AsyncRuntime.run() called from the runtime thread, await the coroutine instead')
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            loop, thread = self._loop, self._thread
+            self._loop, self._thread = None, None
+
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+# Shared by all services of this process
+runtime = AsyncRuntime()
+atexit.register(runtime.stop)
+
+
+LOOPS = ('asyncio', 'uvloop')
+
+
+def install_loop(name):
+    """Makes name one of LOOPS the event loop of the runtime (and of
+    asyncio.run). A running runtime loop is stopped, so services that used
+    it have to be closed before. uvloop is optional and only imported here.
+    """
+    if name == 'uvloop':
+        import uvloop
+        policy = uvloop.EventLoopPolicy()
+    elif name == 'asyncio':
+        policy = asyncio.DefaultEventLoopPolicy()
+    else:
+        raise ValueError(f'Unknown event loop {name}, expected one of {", ".join(LOOPS)}')
+
+    runtime.stop()
+    asyncio.set_event_loop_policy(policy)
@@ -0,0 +1,144 @@
+import asyncio
+import time
+import threading
+
+
+class UploadReport:
+    """Outcome of uploading the pages of a set of offsets."""
+
+    def __init__(self, offsets):
+        self.offsets = list(offsets)
+        self.total = len(self.offsets)
+        self.status = {}
+        self.errors = {}
+        self.bytes = 0
+        self.skipped = []
+        # Content tags of the pages, sent with the uploads
+        self.tags = {}
+        self.start = time.perf_counter()
+        self.end = None
+
+    def record(self, offset, ok, nbytes=0, error=None):
+        self.status[offset] = ok
+        self.bytes += nbytes
+        if ok:
+            self.errors.pop(offset, None)
+        else:
+            self.errors[offset] = error
+
+    def skip(self, offsets):
+        """Offsets whose pages the server already holds."""
+        self.skipped.extend(offsets)
+        for offset in offsets:
+            self.record(offset, True)
+
+    @property
+    def done(self):
+        return len(self.status)
+
+    @property
+    def live(self):
+        return [x for x in self.offsets if self.status.get(x) is True]
+
+    @property
+    def failed(self):
+        return [x for x in self.offsets if self.status.get(x) is False]
+
+    @property
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def __bool__(self):
+        return len(self.live) == self.total
+
+    def __repr__(self):
+        return f'UploadReport({len(self.live)}/{self.total} live, {len(self.skipped)} skipped, {len(self.failed)} failed, {self.bytes / 2**20:.1f} MiB in {self.elapsed:.2f}s)'
+
+
+class UploadScheduler:
+    """Uploads pages with at most limit requests in flight.
+
+    A page body is only built once its upload gets a slot, so memory is
+    bounded by the limit instead of the number of offsets. rate caps the
+    upload volume in bytes per second, failed offsets are retried up to
+    retries times. progress(report) is called after every upload.
+    """
+
+    def __init__(self, limit=16, rate=None, retries=1, progress=None):
+        self.limit = max(1, limit)
+        self.rate = rate
+        self.retries = retries
+        self.progress = progress
+        self._next_send = 0.0
+        self._lock = threading.Lock()
+
+    def _delay(self, nbytes):
+        """Seconds to wait before sending nbytes to stay below the rate."""
+        if not self.rate:
+            return 0.0
+
+        with self._lock:
+            now = time.perf_counter()
+            send_at = max(now, self._next_send)
+            self._next_send = send_at + nbytes / self.rate
+        return send_at - now
+
+    async def _throttle(self, nbytes):
+        delay = self._delay(nbytes)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def throttle(self, nbytes):
+        """Blocking variant for backends that upload from threads."""
+        delay = self._delay(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def run(self, offsets, prepare, send, report=None):
+        """prepare(offset) returns the body, send(offset, body) uploads it
+        and returns whether the server accepted it. Results are recorded
+        in report, a new one unless given."""
+        if report is None:
+            report = UploadReport(offsets)
+        slots = asyncio.Semaphore(self.limit)
+
+        async def upload(offset):
+            async with slots:
+                body = prepare(offset)
+                await self._throttle(len(body))
+                try:
+                    ok, error = await send(offset, body), None
+                except Exception as e:
+                    ok, error = False, e
+                report.record(offset, bool(ok), len(body), error)
+
+            if self.progress:
+                self.progress(report)
+
+        for pending in self._rounds(offsets, report):
+            await asyncio.gather(*[upload(x) for x in pending])
+
+        report.end = time.perf_counter()
+        return report
+
+    def run_blocking(self, offsets, upload, report=None):
+        """Blocking variant of run for backends that upload from threads,
+        upload(pending, report) uploads and records one round of offsets."""
+        if report is None:
+            report = UploadReport(offsets)
+
+        for pending in self._rounds(offsets, report):
+            upload(pending, report)
+
+        report.end = time.perf_counter()
+        return report
+
+    def _rounds(self, offsets, report):
+        """Offsets to upload per attempt, after the first only those that
+        failed."""
+        pending = list(offsets)
+        for _ in range(1 + self.retries):
+            yield pending
+            pending = report.failed
+            if len(pending) == 0:
+                break
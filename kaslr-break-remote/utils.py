@@ -1,11 +1,23 @@
 import os
 import click
 import binascii
-import yaml
-import mmap
+import hashlib
+from addict import Dict
+from lazyimport import lazy_import
 
+from bundle import load_profile_bundle
+from candidates import CANDIDATE_ALIGNMENT
+from pagestore import store, unique_pages
+from relocation import relocation_table, to_u64
+from variant import PageVariant
 
-STEP = (2*1024*1024)
+# Loaded when a profile is read or page variants are built
+yaml = lazy_import('yaml')
+np = lazy_import('numpy')
+
+
+PAGE_SIZE = 4096
+SLOTS_PER_PAGE = PAGE_SIZE // 8
 
 
 def address_to_int_str(value):
@@ -14,53 +26,42 @@ def address_to_int_str(value):
 def address_to_int(ctx, param, value):
     return address_to_int_str(value)
 
-def load_page_from_config(page_file, kernel_text_mapping):
-    click.echo(f'Loading page file {page_file}')
-
+def read_page_file(page_file):
     with open(page_file, 'r') as f:
         page_meta = yaml.safe_load(f)
-        page_content = page_meta['data']
-        page_offsets = page_meta['offsets']
+    return page_meta['data'], page_meta['offsets']
 
-        page = mmap.mmap(-1, 4096, flags=mmap.MAP_PRIVATE, prot=mmap.PROT_READ | mmap.PROT_WRITE)
-        page[0:4096] = page_content[0:4096]
-
-        if page_offsets == -1:
-            page_offsets = [x for x in range(0, 4096, 8)]
+def read_binary_page_file(page_file):
+    with open(page_file, "rb") as f:
+        return f.read(), None
 
-        kernel_offsets = len(page_offsets) * [0]
+def load_page_from_config(page_file, kernel_text_mapping):
+    click.echo(f'Loading page file {page_file}')
 
-        for offset_idx, offset in enumerate(page_offsets):
-            ptr = page_content[offset:offset+8]
-            ptr = int.from_bytes(ptr, byteorder='little', signed=False)
-            kernel_offsets[offset_idx] = ptr - kernel_text_mapping
+    page_key, page_offsets = store.load_file(page_file, read_page_file)
+    page_offsets, kernel_offsets = relocation_table(store.get(page_key), page_offsets, kernel_text_mapping)
 
-    return page, page_offsets, kernel_offsets
+    return page_key, page_offsets, kernel_offsets
 
 def load_binary_page_from_config(page_file, page_offsets, kernel_text_mapping):
     click.echo(f'Loading binary page file {page_file}')
 
-    with open(page_file, "rb") as f:
-        page_content = f.read()
-
-        page = mmap.mmap(-1, 4096, flags=mmap.MAP_PRIVATE, prot=mmap.PROT_READ | mmap.PROT_WRITE)
-        page[0:4096] = page_content[0:4096]
-
-        if page_offsets == -1:
-            page_offsets = [x for x in range(0, 4096, 8)]
-
-        kernel_offsets = len(page_offsets) * [0]
+    page_key, _ = store.load_file(page_file, read_binary_page_file)
+    page_offsets, kernel_offsets = relocation_table(store.get(page_key), page_offsets, kernel_text_mapping)
 
-        for offset_idx, offset in enumerate(page_offsets):
-            ptr = page_content[offset:offset+8]
-            ptr = int.from_bytes(ptr, byteorder='little', signed=False)
-            kernel_offsets[offset_idx] = ptr - kernel_text_mapping
+    return page_key, page_offsets, kernel_offsets
 
-    return page, page_offsets, kernel_offsets
+def page_entry(page_key, page_offsets, kernel_offsets):
+    return Dict({
+        'page': store.get(page_key),
+        'hash': page_key,
+        'offsets': page_offsets,
+        'kernel_offsets': kernel_offsets
+    })
 
 
-def prepare_pages(pages, kernel_text_mapping, kaslr_offset):
-    kaslr_address = kernel_text_mapping + kaslr_offset * STEP
+def prepare_pages(pages, kernel_text_mapping, kaslr_offset, step=CANDIDATE_ALIGNMENT):
+    kaslr_address = kernel_text_mapping + kaslr_offset * step
     page_hex = bytes()
 
     for page in pages:
@@ -74,6 +75,173 @@ def prepare_pages(pages, kernel_text_mapping, kaslr_offset):
     return page_hex
 
 
+class PageVariantBuilder:
+    """Builds the KASLR variants of all pages at once.
+
+    The base pages are held as one (npages, 512) little-endian uint64 array
+    and every relocated slot is stored as (flat slot index, kernel offset).
+    A variant for a KASLR offset is the base array with the relocated slots
+    replaced by `candidate address + kernel offset`, computed for all
+    requested offsets of the CandidateSpace through broadcasting. Arithmetic
+    wraps modulo 2^64 like the pointer it replaces. Pointers that are not
+    8-byte aligned are patched on a byte view of the same array.
+    """
+
+    def __init__(self, pages, candidates):
+        self.candidates = candidates
+        self.npages = len(pages)
+        self.base = np.zeros((self.npages, SLOTS_PER_PAGE), dtype='<u8')
+
+        slot_index, slot_delta = [], []
+        byte_index, byte_delta = [], []
+
+        for page_idx, page in enumerate(pages):
+            self.base[page_idx] = np.frombuffer(page.page[0:PAGE_SIZE], dtype='<u8')
+
+            offsets = np.asarray(page.offsets, dtype=np.intp)
+            deltas = to_u64(page.kernel_offsets)
+            aligned = offsets % 8 == 0
+
+            slot_index.append(page_idx * SLOTS_PER_PAGE + offsets[aligned] // 8)
+            slot_delta.append(deltas[aligned])
+            byte_index.append(page_idx * PAGE_SIZE + offsets[~aligned])
+            byte_delta.append(deltas[~aligned])
+
+        self.slot_index = np.concatenate(slot_index or [np.zeros(0, dtype=np.intp)])
+        self.slot_delta = np.concatenate(slot_delta or [np.zeros(0, dtype='<u8')])
+        self.byte_index = (np.concatenate(byte_index or [np.zeros(0, dtype=np.intp)])[:, None] + np.arange(8)).reshape(-1)
+        self.byte_delta = np.concatenate(byte_delta or [np.zeros(0, dtype='<u8')])
+
+    @property
+    def page_bytes(self):
+        return self.npages * PAGE_SIZE
+
+    @property
+    def fingerprint(self):
+        """Hash of the base pages and relocations, a variant is fully
+        determined by it and the candidate address."""
+        if getattr(self, '_fingerprint', None) is None:
+            h = hashlib.sha256()
+            for x in [self.base, self.slot_index, self.slot_delta, self.byte_index, self.byte_delta]:
+                h.update(np.ascontiguousarray(x).tobytes())
+            self._fingerprint = h.digest()
+        return self._fingerprint
+
+    def tags(self, kaslr_offsets):
+        """Content tag of the variant of every offset, without building it."""
+        return [
+            hashlib.sha256(self.fingerprint + address.to_bytes(8, 'little')).hexdigest()[0:32]
+            for address in self.addresses(kaslr_offsets).tolist()
+        ]
+
+    def addresses(self, kaslr_offsets):
+        return self.candidates.addresses(kaslr_offsets)
+
+    def build(self, kaslr_offsets):
+        """Returns a (len(kaslr_offsets), npages * 4096) uint8 array, one
+        contiguous row of concatenated pages per KASLR offset."""
+        addresses = self.addresses(kaslr_offsets)
+        n = len(addresses)
+
+        variants = np.empty((n, self.npages * SLOTS_PER_PAGE), dtype='<u8')
+        variants[:] = self.base.reshape(1, -1)
+        variants[:, self.slot_index] = addresses[:, None] + self.slot_delta[None, :]
+
+        page_bytes = variants.view(np.uint8)
+        if len(self.byte_delta) > 0:
+            values = (addresses[:, None] + self.byte_delta[None, :]).astype('<u8')
+            page_bytes[:, self.byte_index] = values.view(np.uint8)
+
+        return page_bytes
+
+    def variants(self, kaslr_offsets):
+        """Sparse PageVariant per offset, sharing the base pages."""
+        addresses = self.addresses(kaslr_offsets)
+        slot_values = addresses[:, None] + self.slot_delta[None, :]
+        byte_values = addresses[:, None] + self.byte_delta[None, :]
+
+        return [
+            PageVariant(self, int(kaslr_offset), slot_values[idx].copy(), byte_values[idx].copy())
+            for idx, kaslr_offset in enumerate(kaslr_offsets)
+        ]
+
+    def stream(self, kaslr_offsets):
+        """Yields (offset, PageVariant) for all offsets, built one chunk of
+        the candidate space at a time."""
+        for chunk in self.candidates.chunks(kaslr_offsets):
+            yield from zip(chunk.tolist(), self.variants(chunk))
+
+    def prepare(self, kaslr_offsets):
+        """Same output as calling prepare_pages for every offset."""
+        return [binascii.hexlify(row) for chunk in self.candidates.chunks(kaslr_offsets) for row in self.build(chunk)]
+
+
+def prepare_all_pages(pages, candidates, kaslr_offsets):
+    return PageVariantBuilder(pages, candidates).prepare(kaslr_offsets)
+
+
+def load_profile_pages(config, config_file):
+    pages = []
+
+    if config.binary_pages:
+        config_dir = os.path.dirname(config_file)
+
+        for config_page in config.binary_pages:
+            page_file = os.path.join(config_dir, config_page.file)
+            page_key, page_offsets, kernel_offsets = load_binary_page_from_config(
+               page_file,
+               config_page.offsets,
+               config.kernel_text_mapping
+               )
+
+            pages.append(page_entry(page_key, page_offsets, kernel_offsets))
+
+    if config.pages:
+        config_dir = os.path.dirname(config_file)
+
+        for config_page in config.pages:
+            page_file = os.path.join(config_dir, config_page.file)
+            page_key, page_offsets, kernel_offsets = load_page_from_config(
+               page_file,
+               config.kernel_text_mapping
+               )
+
+            pages.append(page_entry(page_key, page_offsets, kernel_offsets))
+
+    return pages
+
+
+def load_pages(config, config_file, page_files=(), offsets=(), use_bundle=True):
+    if config_file and use_bundle:
+        _, pages = load_profile_bundle(config, config_file, config.kernel_text_mapping)
+    elif config_file:
+        pages = load_profile_pages(config, config_file)
+    else:
+        pages = []
+
+    # Load pages from parameters
+    for idx, page_file in enumerate(page_files):
+        if offsets[idx] == "-1":
+            page_offsets = -1
+        else:
+            page_offsets = [int(x) for x in offsets[idx].split(",")]
+
+        page_key, page_offsets, kernel_offsets = load_binary_page_from_config(
+            page_file,
+            page_offsets,
+            config.kernel_text_mapping
+            )
+
+        pages.append(page_entry(page_key, page_offsets, kernel_offsets))
+
+    # Identical pages would be uploaded twice per KASLR offset
+    unique = unique_pages(pages)
+    if len(unique) < len(pages):
+        click.echo(f'Skipping {len(pages) - len(unique)} duplicate pages')
+
+    return unique
+
+
 def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
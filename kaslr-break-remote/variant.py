@@ -0,0 +1,46 @@
+from lazyimport import lazy_import
+
+np = lazy_import('numpy')
+
+
+class PageVariant:
+    """KASLR variant of the pages of a profile as sparse patches.
+
+    The base pages and the patched slot positions are shared through the
+    PageVariantBuilder, a variant only owns the new pointer values. So
+    memory stays at about one copy of the base pages no matter how many
+    offsets are held. The full pages are only materialized at send time,
+    into a reusable buffer (render) or as bytes (tobytes).
+    """
+
+    __slots__ = ('builder', 'kaslr_offset', 'slot_values', 'byte_values')
+
+    def __init__(self, builder, kaslr_offset, slot_values, byte_values):
+        self.builder = builder
+        self.kaslr_offset = kaslr_offset
+        self.slot_values = slot_values
+        self.byte_values = byte_values
+
+    def __len__(self):
+        return self.builder.page_bytes
+
+    def _patch(self, slots):
+        slots[:] = self.builder.base.reshape(-1)
+        slots[self.builder.slot_index] = self.slot_values
+        if len(self.byte_values) > 0:
+            slots.view(np.uint8)[self.builder.byte_index] = self.byte_values.view(np.uint8)
+
+    def render(self, buffer=None):
+        """Writes the pages into buffer (a bytearray of at least len(self)
+        bytes, allocated if None) and returns a memoryview of them."""
+        if buffer is None:
+            buffer = bytearray(len(self))
+
+        self._patch(np.frombuffer(buffer, dtype='<u8', count=len(self) // 8))
+
+        return memoryview(buffer)[0:len(self)]
+
+    def tobytes(self):
+        slots = np.empty(len(self) // 8, dtype='<u8')
+        self._patch(slots)
+        return slots.tobytes()
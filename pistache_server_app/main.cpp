@@ -8,6 +8,10 @@
 #include <csignal>
 #include <chrono>
 #include <sstream>
+#include <mutex>
+#include <random>
+#include <string>
+#include <vector>
 
 #include <sys/mman.h>
 #include <string.h>
@@ -86,7 +90,9 @@ void handleReady(const Rest::Request&, Http::ResponseWriter response) {
 class KASLREndpoint {
 public:
   explicit KASLREndpoint(Address addr)
-    : httpEndpoint(std::make_shared<Http::Endpoint>(addr))
+    : instance(std::random_device{}()),
+      tags(POSSIBLE_OFFSETS),
+      httpEndpoint(std::make_shared<Http::Endpoint>(addr))
   { }
 
   ~KASLREndpoint() {
@@ -118,6 +124,13 @@ public:
 private:
   char* pages = nullptr;
 
+  // Content tags the client sent with the pages of every offset, so it can
+  // skip uploading pages this process already holds. The instance id
+  // changes with every start, when all pages are gone.
+  uint64_t instance;
+  std::vector<std::string> tags;
+  std::mutex tagsLock;
+
   void setupPages() {
     this->pages = reinterpret_cast<char*>(mmap((void*) 0, PAGES_MEM, PROT_READ|PROT_WRITE, MAP_PRIVATE|MAP_ANONYMOUS|MAP_POPULATE, -1, 0));
     if (this->pages == MAP_FAILED) {
@@ -131,6 +144,7 @@ private:
     Routes::Post(router, "/set-page/:offset", Routes::bind(&KASLREndpoint::setPage, this));
     Routes::Post(router, "/set-byte/:offset", Routes::bind(&KASLREndpoint::setByte, this));
     Routes::Get(router, "/random", Routes::bind(&KASLREndpoint::random, this));
+    Routes::Get(router, "/manifest", Routes::bind(&KASLREndpoint::manifest, this));
     // Routes::Get(router, "/ready", Routes::bind(&Generic::handleReady));
     // Routes::Get(router, "/auth", Routes::bind(&KASLREndpoint::doAuth, this));
 
@@ -141,7 +155,7 @@ private:
 
     std::cout << "[" << gettid() << "] Set page: " << offset << std::endl;
 
-    if (offset > 511) {
+    if (offset < 0 || offset >= POSSIBLE_OFFSETS) {
       std::cout << "[" << gettid() << "] Invalid offset: " << offset << std::endl;
       response.send(Http::Code::Forbidden, std::to_string(offset));
       return;
@@ -150,15 +164,35 @@ private:
     // get data
     auto data = request.body();
 
-    for (size_t idx = 0, i = 0; i < data.size(); idx++, i += 4096*2) {
-      size_t start = offset * (MAX_NUM_PAGES * PAGE_SIZE) + (idx * PAGE_SIZE);
+    // raw page memory instead of hex
+    bool binary = request.headers().hasRaw("X-Page-Encoding") &&
+      request.headers().getRaw("X-Page-Encoding").value() == "binary";
+
+    if (binary) {
+      for (size_t idx = 0, i = 0; i + PAGE_SIZE <= data.size() && idx < MAX_NUM_PAGES; idx++, i += PAGE_SIZE) {
+        size_t start = offset * (MAX_NUM_PAGES * PAGE_SIZE) + (idx * PAGE_SIZE);
 
-      char buffer[4096];
-      unhexlify(&data[0] + i, buffer, 4096*2);
+        memcpy(pages + start, &data[0] + i, PAGE_SIZE);
+      }
+    } else {
+      for (size_t idx = 0, i = 0; i < data.size(); idx++, i += 4096*2) {
+        size_t start = offset * (MAX_NUM_PAGES * PAGE_SIZE) + (idx * PAGE_SIZE);
+
+        char buffer[4096];
+        unhexlify(&data[0] + i, buffer, 4096*2);
 
-      memcpy(pages + start, buffer, 4096);
+        memcpy(pages + start, buffer, 4096);
+      }
     }
 
+    {
+      std::lock_guard<std::mutex> lock(tagsLock);
+      if (request.headers().hasRaw("X-Page-Tag")) {
+        tags[offset] = request.headers().getRaw("X-Page-Tag").value();
+      } else {
+        tags[offset].clear();
+      }
+    }
 
     response.send(Http::Code::Ok, std::to_string(offset));
   }
@@ -168,7 +202,7 @@ private:
 
     std::cout << "[" << gettid() << "] Set byte: " << offset << std::endl;
 
-    if (offset > 511) {
+    if (offset < 0 || offset >= POSSIBLE_OFFSETS) {
       std::cout << "[" << gettid() << "] Invalid offset: " << offset << std::endl;
       response.send(Http::Code::Forbidden, std::to_string(offset));
       return;
@@ -198,6 +232,23 @@ private:
     response.send(Http::Code::Ok, "OK");
   }
 
+  // Instance id, then one "offset,tag" line per tagged offset
+  void manifest(const Rest::Request& request, Http::ResponseWriter response) {
+    std::ostringstream r;
+    r << std::hex << instance << std::dec << "\n";
+
+    {
+      std::lock_guard<std::mutex> lock(tagsLock);
+      for (size_t offset = 0; offset < tags.size(); offset++) {
+        if (!tags[offset].empty()) {
+          r << offset << "," << tags[offset] << "\n";
+        }
+      }
+    }
+
+    response.send(Http::Code::Ok, r.str());
+  }
+
   std::shared_ptr<Http::Endpoint> httpEndpoint;
   Rest::Router router;
 };